@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for iiitools' parsing and record accessors.
+
+Runs against the recorded WebPac pages in benchmarks/fixtures (serials,
+monographs, long 505/520 fields, heavy entity escaping and latin1 data), so
+no network access is needed. Each benchmark runs in its own process and
+reports items/sec (best of several rounds) and how far memory use rose
+above what the process had after loading the corpus.
+Results are appended to a JSON lines history file and compared against
+the median of the previous runs on the same host and Python version;
+anything slower or bigger than that by more than the threshold is flagged
+as a regression and the exit status is 1.
+
+Usage: python benchmarks/bench.py [options] [benchmark names]
+"""
+
+import glob
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import re
+import resource
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import iiitools
+
+FIXTURES = os.path.join(HERE, 'fixtures')
+HISTORY = os.path.join(HERE, 'history.jsonl')
+
+
+def load_corpus():
+    r"""
+    Returns a dict with the fixture pages: 'marc_pages' and
+    'holdings_pages' (raw latin1 strings), 'marc' (the extracted proto-MARC
+    text of each MARC page that has some) and 'records' (marc, decoded).
+    """
+    reader = iiitools.Reader('http://opac.uthsc.edu', 2)
+    corpus = {}
+    for kind in ('marc', 'holdings'):
+        pages = []
+        for path in sorted(glob.glob(os.path.join(FIXTURES, kind + '_*.html'))):
+            pages.append(open(path, 'rb').read())
+        corpus[kind + '_pages'] = pages
+    corpus['marc'] = []
+    corpus['records'] = []
+    for page in corpus['marc_pages']:
+        marc = reader.extract_marc(page)
+        if marc:
+            bibnumber = re.search(r'/\.(b\d+)/', page).group(1)
+            corpus['marc'].append(marc)
+            corpus['records'].append(reader.make_record(bibnumber, marc))
+    return corpus
+
+
+def bench_extract_marc(corpus):
+    reader = iiitools.Reader('http://opac.uthsc.edu', 2)
+    pages = corpus['marc_pages']
+    return lambda: map(reader.extract_marc, pages), len(pages)
+
+
+def bench_decode_record(corpus):
+    reader = iiitools.Reader('http://opac.uthsc.edu', 2)
+    marc = corpus['marc']
+    return lambda: map(reader.decode_record, marc), len(marc)
+
+
+def bench_unescape_entities(corpus):
+    lines = [line for m in corpus['marc'] for line in m.split('\n') if '&' in line]
+    return lambda: map(iiitools.unescape_entities, lines), len(lines)
+
+
+def bench_leader_type(corpus):
+    leaders = [record.leader for record in corpus['records']] * 100
+    return lambda: [leader.type for leader in leaders], len(leaders)
+
+
+def bench_record_dict(corpus):
+    records = corpus['records']
+    def run():
+        for record in records:
+            # Drop cached accessor values so every call does the work
+            record._property_cache = {}
+            record.__dict__()
+    return run, len(records)
+
+
+def bench_holdings_parse(corpus):
+    pages = corpus['holdings_pages']
+    def run():
+        for page in pages:
+            iiitools.HoldingsParser().parse(page)
+    return run, len(pages)
+
+
+def accessor_bench(name, func):
+    def bench(corpus):
+        records = corpus['records']
+        return lambda: [func(record) for record in records], len(records)
+    return bench
+
+
+BENCHMARKS = [
+    ('extract_marc', bench_extract_marc),
+    ('decode_record', bench_decode_record),
+    ('unescape_entities', bench_unescape_entities),
+    ('Leader.type', bench_leader_type),
+    ('Record.__dict__', bench_record_dict),
+    ('HoldingsParser.parse', bench_holdings_parse),
+]
+# Every Record accessor, uncached (record_property keeps the function)
+for _name in sorted(dir(iiitools.Record)):
+    _prop = getattr(iiitools.Record, _name)
+    if isinstance(_prop, iiitools.record_property):
+        BENCHMARKS.append(('Record.' + _name, accessor_bench(_name, _prop.func)))
+    elif _name == 'check_digit':
+        BENCHMARKS.append(('Record.' + _name, accessor_bench(_name, _prop.fget)))
+del _name, _prop
+
+
+def current_rss_kb():
+    r"""The process's resident set size in KB, or None without /proc."""
+    try:
+        statm = open('/proc/self/statm').read()
+    except IOError:
+        return None
+    return int(statm.split()[1]) * resource.getpagesize() // 1024
+
+
+def max_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024 # bytes on OS X, KB elsewhere
+    return peak
+
+
+class RSSSampler(threading.Thread):
+    r"""Polls current_rss_kb every interval seconds, keeping the highest."""
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = None
+        self._stopped = threading.Event()
+
+    def reset(self):
+        self.peak = current_rss_kb()
+        return self.peak
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss_kb())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss_kb())
+        return self.peak
+
+
+def measure(setup, min_time, rounds):
+    r"""
+    Runs the benchmark made by setup and returns its best items/sec over
+    rounds rounds of at least min_time seconds each, and its peak memory
+    growth: how far RSS rose (in KB) above where it was once the corpus
+    was loaded. RSS is sampled while the benchmark runs where /proc is
+    available; elsewhere the growth of the max RSS is used, which misses
+    growth that stays under the peak from loading the corpus.
+    """
+    func, items = setup(load_corpus())
+    if current_rss_kb() is None:
+        sampler = None
+        baseline = max_rss_kb()
+    else:
+        sampler = RSSSampler()
+        sampler.start()
+        # After starting the sampler, so its thread doesn't count
+        baseline = sampler.reset()
+    func() # Warm up
+    best = 0.0
+    for i in range(rounds):
+        calls = 0
+        started = time.time()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.time() - started
+            if elapsed >= min_time:
+                break
+        best = max(best, calls * items / elapsed)
+    peak = sampler.stop() if sampler is not None else max_rss_kb()
+    return {'per_sec': best, 'peak_growth_kb': max(0, peak - baseline)}
+
+
+def _measure_in_child(queue, setup, min_time, rounds):
+    queue.put(measure(setup, min_time, rounds))
+
+
+def run_isolated(setup, min_time, rounds):
+    r"""Runs measure in a fresh process so peak memory is per benchmark."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_in_child,
+                                      args=(queue, setup, min_time, rounds))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    runs = []
+    for line in open(path):
+        if line.strip():
+            runs.append(json.loads(line))
+    return runs
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def find_regressions(results, history, threshold, window=5, memory_slack=256):
+    r"""
+    Compares results with the median of the last window runs in history
+    and returns a list of (benchmark, metric, baseline, value) for each
+    one that got worse by more than threshold (a fraction). Memory growth
+    also has to be more than memory_slack KB over the baseline, since a
+    few pages either way is noise.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = [run['results'][name] for run in history
+                    if name in run['results']][-window:]
+        if not previous:
+            continue
+        baseline = median([p['per_sec'] for p in previous])
+        if result['per_sec'] < baseline * (1 - threshold):
+            regressions.append((name, 'per_sec', baseline, result['per_sec']))
+        # Runs from before peak_growth_kb recorded the whole process's peak
+        previous = [p['peak_growth_kb'] for p in previous if 'peak_growth_kb' in p]
+        if not previous:
+            continue
+        baseline = median(previous)
+        value = result['peak_growth_kb']
+        if value > baseline * (1 + threshold) and value > baseline + memory_slack:
+            regressions.append((name, 'peak_growth_kb', baseline, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark names]')
+    parser.add_option('--history', default=HISTORY,
+                      help='JSON lines file of previous results [%default]')
+    parser.add_option('--no-save', action='store_true',
+                      help="don't append this run to the history file")
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='fraction a result may get worse before it is '
+                           'flagged as a regression [%default]')
+    parser.add_option('--memory-slack', type='int', default=256,
+                      help='KB of memory growth over the baseline to ignore '
+                           '[%default]')
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help='minimum seconds per round [%default]')
+    parser.add_option('--rounds', type='int', default=3,
+                      help='rounds per benchmark (the best one counts) [%default]')
+    parser.add_option('--list', action='store_true', help='list benchmarks and exit')
+    options, names = parser.parse_args(argv)
+
+    if options.list:
+        for name, setup in BENCHMARKS:
+            print name
+        return 0
+    unknown = set(names) - set(name for name, setup in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark(s): %s' % ', '.join(sorted(unknown)))
+
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results[name] = run_isolated(setup, options.min_time, options.rounds)
+        print '%-40s %12.1f /s %10d KB' % (name, results[name]['per_sec'],
+                                           results[name]['peak_growth_kb'])
+
+    run = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'iiitools': iiitools.__version__,
+        'results': results,
+    }
+    history = [r for r in read_history(options.history)
+               if r['host'] == run['host'] and r['python'] == run['python']]
+    regressions = find_regressions(results, history, options.threshold,
+                                   memory_slack=options.memory_slack)
+    for name, metric, baseline, value in regressions:
+        print 'REGRESSION %s %s: %.1f -> %.1f' % (name, metric, baseline, value)
+
+    if not options.no_save:
+        out = open(options.history, 'a')
+        try:
+            out.write(json.dumps(run, sort_keys=True) + '\n')
+        finally:
+            out.close()
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test for Reader against the local replay server (see
+replay_server.py), or any other OPAC given with --url.
+
+Drives Reader.crawl_records (--mode crawl) or concurrent get_record calls
+(--mode get_record) over a bib range at the given concurrency, and reports
+throughput, p50/p99 get_record latency, request counts from Reader's
+Metrics and the client's peak memory. The replay server runs in a child
+process, so it doesn't share the client's GIL or show up in its memory.
+
+Usage: python benchmarks/loadtest.py [options]
+"""
+
+import math
+import multiprocessing
+import optparse
+import os
+import resource
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import iiitools
+import replay_server
+
+
+def percentile(values, fraction):
+    r"""Nearest-rank percentile of values (fraction is 0.0 to 1.0)."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, int(math.ceil(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _serve(port, options, queue):
+    server = replay_server.ReplayServer(('127.0.0.1', port), **options)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def spawn_server(port, options):
+    r"""Starts a replay server in a child process; returns (process, url)."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(port, options, queue))
+    process.daemon = True
+    process.start()
+    return process, queue.get()
+
+
+class TimedReader(iiitools.Reader):
+    r"""
+    Reader that records how long each get_record call takes, and counts 
+    (rather than raises) RequestErrors once the scheduler gives up.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedReader, self).__init__(*args, **kwargs)
+        self.latencies = []
+        self.failures = 0
+        self._latency_lock = threading.Lock()
+
+    def get_record(self, bibnumber):
+        started = time.time()
+        try:
+            return super(TimedReader, self).get_record(bibnumber)
+        except iiitools.RequestError:
+            self._latency_lock.acquire()
+            self.failures += 1
+            self._latency_lock.release()
+            return None
+        finally:
+            elapsed = time.time() - started
+            self._latency_lock.acquire()
+            self.latencies.append(elapsed)
+            self._latency_lock.release()
+
+
+def run(reader, bib_start, bib_end, mode, concurrency):
+    r"""Runs the load and returns the number of records retrieved."""
+    if mode == 'crawl':
+        return len(reader.crawl_records(bib_start, bib_end, workers=concurrency,
+                                        ordered=False))
+    pool = ThreadPool(concurrency)
+    try:
+        records = pool.map(reader.get_record, iiitools.bib_range(bib_start, bib_end))
+    finally:
+        pool.close()
+        pool.join()
+    return len([r for r in records if r])
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--url', help='OPAC to test instead of a replay server')
+    parser.add_option('--port', type='int', default=0,
+                      help='replay server port; fix it to reuse a page cache '
+                           'across runs [any free port]')
+    parser.add_option('--scope', default='2', help='[%default]')
+    parser.add_option('--start', default='b1000000', help='first bib number [%default]')
+    parser.add_option('--count', type='int', default=500,
+                      help='number of bib numbers [%default]')
+    parser.add_option('--mode', choices=['crawl', 'get_record'], default='crawl',
+                      help='crawl or get_record [%default]')
+    parser.add_option('--concurrency', type='int', default=8, help='[%default]')
+    parser.add_option('--optimistic', action='store_true')
+    parser.add_option('--stream-marc', action='store_true')
+    parser.add_option('--page-cache', metavar='PATH',
+                      help='use a PageCache stored at PATH')
+    parser.add_option('--rate', type='float',
+                      help='use a RequestScheduler with this many requests/sec')
+    parser.add_option('--retries', type='int', default=3,
+                      help='scheduler retries [%default]')
+    replay_server.add_server_options(parser)
+    options, args = parser.parse_args(argv)
+
+    server = None
+    url = options.url
+    if url is None:
+        server, url = spawn_server(options.port, replay_server.server_options(options))
+
+    scheduler = None
+    if options.rate or options.error_rate:
+        scheduler = iiitools.RequestScheduler(
+            rate=options.rate, max_concurrency=options.concurrency,
+            max_retries=options.retries, backoff=0.05, max_backoff=1.0)
+    cache = iiitools.PageCache(options.page_cache) if options.page_cache else None
+    metrics = iiitools.Metrics()
+    reader = TimedReader(url, options.scope, optimistic=options.optimistic,
+                         stream_marc=options.stream_marc, cache=cache,
+                         scheduler=scheduler, metrics=metrics)
+
+    bib_start = options.start
+    bib_end = 'b%d' % (int(bib_start[1:]) + options.count - 1)
+    started = time.time()
+    try:
+        records = run(reader, bib_start, bib_end, options.mode, options.concurrency)
+    finally:
+        elapsed = time.time() - started
+        if server is not None:
+            server.terminate()
+        if cache is not None:
+            cache.close()
+
+    counters = metrics.snapshot()['counters']
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    print 'bib numbers:   %d (%s-%s) against %s' % (options.count, bib_start, bib_end, url)
+    print 'records:       %d in %.2fs, %.1f records/s' % (records, elapsed, records / elapsed)
+    print 'requests:      %d, %.1f/s, %d HTTP errors' % (
+        counters.get('requests', 0), counters.get('requests', 0) / elapsed,
+        counters.get('http_errors', 0))
+    print 'get_record:    p50 %.1f ms, p99 %.1f ms, %d failed' % (
+        percentile(reader.latencies, 0.5) * 1000,
+        percentile(reader.latencies, 0.99) * 1000, reader.failures)
+    if cache is not None:
+        print 'page cache:    %s' % ', '.join('%s %d' % item for item in sorted(cache.stats.items()))
+    if scheduler is not None:
+        print 'scheduler:     %s' % ', '.join('%s %s' % item for item in sorted(scheduler.stats.items()))
+    print 'peak memory:   %d KB' % peak
+
+
+if __name__ == '__main__':
+    main()
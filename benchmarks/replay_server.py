@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for a WebPac OPAC, for testing Reader without touching the
+production server.
+
+Serves the recorded pages in benchmarks/fixtures at the URLs Reader asks
+for (Reader.URI_FOR_RECORD, URI_FOR_MARC and URI_FOR_HOLDINGS, plus the
+'additional copies' holdings link). Every bib number gets one of the MARC
+fixtures, chosen by the number, so repeated requests see the same record.
+Responses carry an ETag and honour If-None-Match, which lets PageCache
+revalidate. Latency, jitter, injected errors and 'No Such Record' gaps are
+configurable.
+
+Usage: python benchmarks/replay_server.py [--port 8080] [options]
+"""
+
+import BaseHTTPServer
+import glob
+import hashlib
+import optparse
+import os
+import random
+import re
+import SocketServer
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+
+NOT_FOUND_PAGE = 'marc_no_such_record.html'
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    r"""
+    Threaded HTTP server replaying the fixture pages.
+
+    latency is the base delay (in seconds) before each response, and up to
+    jitter seconds are added at random. error_rate is the fraction of
+    requests answered with error_status instead. gap_rate is the fraction
+    of bib numbers that don't exist, and every bib number above max_bib is
+    missing too, as at the end of a real catalog.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=503, gap_rate=0.0,
+                 max_bib=None, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplayHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.gap_rate = gap_rate
+        self.max_bib = max_bib
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        self.pages = {}
+        for path in glob.glob(os.path.join(FIXTURES, '*.html')):
+            self.pages[os.path.basename(path)] = open(path, 'rb').read()
+        self.marc_pages = sorted(name for name in self.pages
+                                 if name.startswith('marc_') and name != NOT_FOUND_PAGE)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def exists(self, num):
+        r"""Whether bib number num exists (the same answer every time)."""
+        if self.max_bib is not None and num > self.max_bib:
+            return False
+        # Seeded per number, so gaps don't depend on request order
+        return random.Random('%s:%d' % (self.seed, num)).random() >= self.gap_rate
+
+    def marc_page(self, num):
+        return self.pages[self.marc_pages[num % len(self.marc_pages)]]
+
+    def record_page(self, num):
+        title = re.search(r'\n245 ..(.*)', self.marc_page(num)).group(1)
+        return ('<html><head><title>UTHSC Libraries /All Locations</title></head>'
+                '<body><table class="bibDetail"><tr><td class="bibInfoLabel">Title</td>'
+                '<td class="bibInfoData"><strong>%s</strong></td></tr></table>'
+                '</body></html>\n' % title.strip())
+
+    def holdings_page(self, num, more):
+        # Serials get the long page (with its 'additional copies' link)
+        if more or 'cas ' not in self.marc_page(num):
+            return self.pages['holdings_short.html']
+        return self.pages['holdings_long.html']
+
+    def delay(self):
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            delay = self.latency + self.random.random() * self.jitter
+            fail = self.random.random() < self.error_rate
+        finally:
+            self._lock.release()
+        return delay, fail
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # Keep-alive, as WebPac does
+    disable_nagle_algorithm = True
+    wbufsize = -1 # Send each response in one go (see respond)
+
+    BIB_REGEX = re.compile(r'(?:record=|\.)b(\d+)')
+
+    def do_GET(self):
+        delay, fail = self.server.delay()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            return self.respond(self.server.error_status, 'Server Error\n')
+
+        match = self.BIB_REGEX.search(self.path)
+        if not match:
+            return self.respond(404, 'Not Found\n')
+        num = int(match.group(1))
+        if not self.server.exists(num):
+            return self.respond(200, self.server.pages[NOT_FOUND_PAGE])
+        if '/record=' in self.path:
+            page = self.server.record_page(num)
+        elif '/marc~' in self.path:
+            page = self.server.marc_page(num)
+        elif '/holdings' in self.path:
+            page = self.server.holdings_page(num, '/holdings~' in self.path)
+        else:
+            return self.respond(404, 'Not Found\n')
+        self.respond(200, page)
+
+    def respond(self, status, body):
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=iso-8859-1')
+        self.send_header('Content-Length', str(len(body)))
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(**options):
+    r"""
+    Starts a ReplayServer on a background thread and returns it; its url
+    attribute is the host to give Reader. Call shutdown() to stop it.
+    """
+    server = ReplayServer(**options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_server_options(parser):
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds before each response [%default]')
+    parser.add_option('--jitter', type='float', default=0.0,
+                      help='up to this many extra seconds, at random [%default]')
+    parser.add_option('--error-rate', type='float', default=0.0,
+                      help='fraction of requests that fail [%default]')
+    parser.add_option('--error-status', type='int', default=503,
+                      help='status code of injected errors [%default]')
+    parser.add_option('--gap-rate', type='float', default=0.0,
+                      help="fraction of bib numbers that don't exist [%default]")
+    parser.add_option('--max-bib', type='int',
+                      help='highest bib number that exists')
+    parser.add_option('--seed', type='int', help='random seed')
+
+
+def server_options(options):
+    return dict(latency=options.latency, jitter=options.jitter,
+                error_rate=options.error_rate, error_status=options.error_status,
+                gap_rate=options.gap_rate, max_bib=options.max_bib,
+                seed=options.seed)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1', help='[%default]')
+    parser.add_option('--port', type='int', default=8080, help='[%default]')
+    add_server_options(parser)
+    options, args = parser.parse_args(argv)
+    server = ReplayServer((options.host, options.port), **server_options(options))
+    print 'Serving WebPac fixtures at %s' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@ iiiutils
 Utilities for interacting with III Millennium WebPac. Primary goal is to
 retrieve and parse bibliographic records via the WebPac proto-MARC output.
 
-Requirements:   Python 2.5 or later
+Requirements:   Python 2.7 or later
                 httplib2 <http://code.google.com/p/httplib2/>
                 pymarc <http://github.com/edsu/pymarc>
 """
@@ -14,13 +14,35 @@ Requirements:   Python 2.5 or later
 __author__ = "Matt Grayson (mattgrayson@uthsc.edu)"
 __copyright__ = "Copyright 2009, Matt Grayson"
 __license__ = "MIT"
-__version__ = "1.07"
+__version__ = "1.08"
 
+import array
+import codecs
+import hashlib
+import htmlentitydefs
+import httplib
 import httplib2
+import json
+import mmap
+import os
+import Queue
+import random
 import re
+import socket
+import sqlite3
 import string
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from collections import deque, OrderedDict
+from cStringIO import StringIO
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pymarc import Record, Field
 from string import Template
+from xml.sax.saxutils import escape, quoteattr
 
 class Leader(object):
     """
@@ -28,13 +50,41 @@ class Leader(object):
     Ported from http://github.com/rsinger/enhanced-marc/blob/master/lib/enhanced_marc/leader.rb
     
     Used by iiitools.Record to determine the record type.
+    
+    >>> Leader('00000cas  2200517 a 4500').type
+    'SER'
+    >>> Leader('00000cam  2200517 a 4500').type
+    'BKS'
     """
+    __slots__ = ('data',)
+    
+    # Record types in order of precedence, as (type, type codes, blvl codes)
+    RECORD_TYPES = (
+        ('SER', 'a',    'bis'),
+        ('BKS', 'at',   'acdim'),
+        ('VIS', 'gkro', 'abcdims'),
+        ('MIX', 'p',    'cdi'),
+        ('MAP', 'ef',   'abcdims'),
+        ('SCO', 'cd',   'abcdims'),
+        ('REC', 'ij',   'abcdims'),
+        ('COM', 'm',    'abcdims'),
+    )
+    
+    # type_code + blvl_code => record type, filled in below
+    TYPES = {}
+    
     def __init__(self, data):        
         self.data = data
     
     def __str__(self):
         return self.data
     
+    def __getitem__(self, index):
+        return self.data[index]
+    
+    def __len__(self):
+        return len(self.data)
+    
     def is_archival(self):
         return True if self[8] == 'a' else False
     
@@ -44,28 +94,12 @@ class Leader(object):
     
     @property
     def type(self):
-        valid_types = ['a','t','g','k','r','o','p','e','f','c','d','i','j','m']
         try:
-            valid_types.index(self.type_code)
-        except ValueError:
-            raise ValueError("Invalid Type!")
-        
-        rec_types = {
-            'BKS': { 'type': r'[at]{1}',     'blvl': r'[acdim]{1}' },
-            'SER': { 'type': r'[a]{1}',      'blvl': r'[bis]{1}' },
-            'VIS': { 'type': r'[gkro]{1}',   'blvl': r'[abcdims]{1}' },
-            'MIX': { 'type': r'[p]{1}',      'blvl': r'[cdi]{1}' },
-            'MAP': { 'type': r'[ef]{1}',     'blvl': r'[abcdims]{1}' },
-            'SCO': { 'type': r'[cd]{1}',     'blvl': r'[abcdims]{1}' },
-            'REC': { 'type': r'[ij]{1}',     'blvl': r'[abcdims]{1}' },
-            'COM': { 'type': r'[m]{1}',      'blvl': r'[abcdims]{1}' }
-        }
-        
-        for type in rec_types:            
-            if re.match(rec_types[type]['type'], self.type_code) and re.match(rec_types[type]['blvl'],self.blvl_code):
-                return type
-        
-        raise ValueError("Invalid BLvl!")
+            return self.TYPES[self.data[6:8]]
+        except KeyError:
+            if self.type_code not in VALID_TYPE_CODES:
+                raise ValueError("Invalid Type!")
+            raise ValueError("Invalid BLvl!")
     
     @property
     def blvl_code(self):
@@ -127,6 +161,33 @@ class Leader(object):
 
 
 
+class record_property(property):
+    r"""
+    Property for iiitools.Record accessors. The value is computed once and 
+    cached on the record until its fields change (see Record.tag_index). 
+    Changes made to a field in place aren't detected.
+    """
+    def __init__(self, func):
+        name = func.__name__
+        def fget(record):
+            record.tag_index()
+            try:
+                return record._property_cache[name]
+            except KeyError:
+                value = record._property_cache[name] = func(record)
+                return value
+        super(record_property, self).__init__(fget, doc=func.__doc__)
+        self.func = func
+
+
+for _type, _type_codes, _blvl_codes in Leader.RECORD_TYPES:
+    for _type_code in _type_codes:
+        for _blvl_code in _blvl_codes:
+            Leader.TYPES.setdefault(_type_code + _blvl_code, _type)
+VALID_TYPE_CODES = frozenset(key[0] for key in Leader.TYPES)
+del _type, _type_codes, _blvl_codes, _type_code, _blvl_code
+
+
 class Record(Record):
     r"""
     Extension to pymarc.Record. Some methods and properties are just 
@@ -159,7 +220,54 @@ class Record(Record):
 
     ISSN_ISBN_PATTERN = re.compile('^([\w\d-]+)')
 
+    # Keys of Record.as_dict()/__dict__() and the attributes they come from
+    DICT_KEYS = (
+        ('bibnumber', 'bibnumber'),
+        ('check_digit', 'check_digit'),
+        ('call_number', 'call_number'),
+        ('src_host', 'src_host'),
+        ('record_url', 'record_url'),
+        ('record_marc_url', 'record_marc_url'),
+        ('type', 'type'),
+        ('title', 'title'),
+        ('issn', 'issn'),
+        ('isbn', 'isbn'),
+        ('publishers', 'publishers'),
+        ('publisher_names', 'publisher_names'),
+        ('author', 'author'),
+        ('links', 'links'),
+        ('author_name', 'author_name'),
+        ('author_dates', 'author_dates'),
+        ('other_authors', 'other_authors'),
+        ('title_uniform', 'title_uniform'),
+        ('title_abbrv', 'title_abbrv'),
+        ('title_key', 'title_key'),
+        ('title_varying_forms', 'title_varying_forms'),
+        ('edition', 'edition'),
+        ('comp_file_characteristics', 'comp_file_characteristics'),
+        ('physical_description', 'physical_description'),
+        ('pub_frequency', 'pub_frequency'),
+        ('former_pub_frequencies', 'former_pub_frequencies'),
+        ('pub_dates', 'pub_dates'),
+        ('series', 'series'),
+        ('notes', 'notes'),
+        ('summary', 'summary'),
+        ('contents', 'contents'),
+        ('subjects', 'subjects'),
+        ('preceding_titles', 'entry_preceding'),
+        ('succeeding_titles', 'entry_succeeding'),
+        ('entry_notes', 'entry_notes'),
+    )
+    
+    # Attributes set in __init__ rather than defined on the class
+    INSTANCE_ATTRS = ('type', 'bibnumber', 'raw', 'src_host', 'record_url', 
+                      'record_marc_url', 'leader', 'fields')
+
     def __init__(self, *args, **kwargs):
+        self._index = None
+        self._indexed_fields = None
+        self._indexed_count = 0
+        self._property_cache = {}
         super(Record, self).__init__(*args, **kwargs)
         self.type = None
         self.bibnumber = None
@@ -173,48 +281,95 @@ class Record(Record):
         self.leader = Leader(self.leader)
         self.type = self.leader.type
 
+    def tag_index(self):
+        r"""
+        Returns a dict mapping each tag to the list of fields with that tag, 
+        in record order. The index is rebuilt (and cached accessor values 
+        discarded) whenever the record's fields change.
+        
+        >>> record = Record()
+        >>> record.add_field(Field('650', [' ', '0'], ['a', 'Genetics.']))
+        >>> record.subjects
+        ['Genetics.']
+        >>> record.add_field(Field('650', [' ', '0'], ['a', 'Heredity.']))
+        >>> record.subjects
+        ['Genetics.', 'Heredity.']
+        >>> record.remove_field(record['650'])
+        >>> record.subjects
+        ['Heredity.']
+        """
+        fields = self.fields
+        if self._indexed_fields is not fields or self._indexed_count != len(fields):
+            index = {}
+            for field in fields:
+                index.setdefault(field.tag, []).append(field)
+            self._index = index
+            self._indexed_fields = fields
+            self._indexed_count = len(fields)
+            self._property_cache = {}
+        return self._index
+    
+    def add_field(self, *fields):
+        super(Record, self).add_field(*fields)
+        self._indexed_fields = None
+    
+    def remove_field(self, *fields):
+        try:
+            super(Record, self).remove_field(*fields)
+        finally:
+            self._indexed_fields = None
+    
+    def get_fields(self, *args):
+        if len(args) != 1:
+            return super(Record, self).get_fields(*args)
+        return list(self.tag_index().get(args[0], ()))
+    
+    def __getitem__(self, tag):
+        fields = self.tag_index().get(tag)
+        return fields[0] if fields else None
+
     def has_link(self):
         return True if self['856'] else False
 
     # Turn certain pymarc.Record attribute methods into properties
-    addedentries = property(Record.addedentries)
-    location = property(Record.location)        
-    pubyear = property(Record.pubyear)
+    addedentries = record_property(Record.addedentries)
+    location = record_property(Record.location)        
+    pubyear = record_property(Record.pubyear)
     
     # Accessor methods for various fields
-    @property
+    @record_property
     def access_restrictions(self):
         return "; ".join([f.format_field() for f in self.get_fields('506')])
     
-    @property
+    @record_property
     def author(self):
         for field in ('100','110','111'):
             if self[field]:
                 return self[field].format_field()
         return ''
     
-    @property
+    @record_property
     def author_name(self):
         for field in ('100','110','111'):
             if self[field] and self[field]['a']:
                 return self[field].get_subfields('a')[0]
         return ''
     
-    @property
+    @record_property
     def author_dates(self):
         for field in ('100','110','111'):
             if self[field] and self[field]['c']:
                 return self[field].get_subfields('c')
         return []
 
-    @property
+    @record_property
     def other_authors(self):
         for field in ('700','710','711'):
             if self.get_fields(field):
                 return [f.format_field() for f in self.get_fields(field)]
         return []
 
-    @property
+    @record_property
     def call_number(self):
         if self['096']:
             return self['096'].format_field()
@@ -222,33 +377,33 @@ class Record(Record):
             return self['060'].format_field()
         return ''
 
-    @property
+    @record_property
     def comp_file_characteristics(self):
         return self['256'].format_field() if self['256'] else ''
 
-    @property
+    @record_property
     def contents(self):
         return " ".join([f.format_field() for f in self.get_fields('505')])
     
-    @property
+    @record_property
     def date_published(self):
         return self['260']['c'] if (self['260'] and self['260']['c']) else ''
     
-    @property
+    @record_property
     def edition(self):
         return self['250'].format_field() if self['250'] else ''
 
-    @property
+    @record_property
     def entry_preceding_is_union(self):
         if self['780']:
             return True if self['780'].indicator2 == ("4") else False
-        return false
+        return False
 
-    @property
+    @record_property
     def entry_notes(self):
         return [f.format_field() for f in self.get_fields('580')]
 
-    @property
+    @record_property
     def entry_preceding(self):
         return [{
                     'title': ("%s %s" % (f['a'], f['t'])).strip(),
@@ -256,7 +411,7 @@ class Record(Record):
                     'rel': self.PRECEEDING_ENTRY_LABELS[int(f.indicator2)]
                 } for f in self.get_fields('780')]
 
-    @property
+    @record_property
     def entry_succeeding(self):
         return [{
                     'title': ("%s %s" % (f['a'], f['t'])).strip(),
@@ -264,21 +419,21 @@ class Record(Record):
                     'rel': self.SUCCEEDING_ENTRY_LABELS[int(f.indicator2)] if f.indicator2.strip() else ''
                 } for f in self.get_fields('785')]
 
-    @property
+    @record_property
     def isbn(self):
         if self.get_fields('020'):
             return [self.ISSN_ISBN_PATTERN.match(f['a']).group() for f in self.get_fields('020') if self.ISSN_ISBN_PATTERN.match(f['a'])]
         else:
             return []
 
-    @property
+    @record_property
     def issn(self):
         if self.get_fields('022'):
             return [self.ISSN_ISBN_PATTERN.match(f['a']).group() for f in self.get_fields('022') if self.ISSN_ISBN_PATTERN.match(f['a'])]
         else:
             return []
 
-    @property
+    @record_property
     def links(self):
         if self.has_link():
             # u/a subfield check required in case the URL accidentally gets 
@@ -292,93 +447,94 @@ class Record(Record):
                     ]
         return []
 
-    @property
+    @record_property
     def notes(self):
-        ignore = [505,506,520,580,590] # 590 is a local notes field that isn't particularly relevant outside of III
+        ignore = ['505','506','520','580','590'] # 590 is a local notes field that isn't particularly relevant outside of III
         notes = []
-        for field in range(500, 599):
-            if field in ignore: continue
-            notes += [f.format_field() for f in self.get_fields(field.__str__())]
+        index = self.tag_index()
+        for tag in sorted(index):
+            if '500' <= tag <= '598' and tag.isdigit() and tag not in ignore:
+                notes += [f.format_field() for f in index[tag]]
         return notes
     
-    @property
+    @record_property
     def physical_description(self):
         return "; ".join([f.format_field() for f in self.get_fields('300')])
     
-    @property
+    @record_property
     def publishers(self):
         return [f.format_field() for f in self.get_fields('260')]
     
-    @property
+    @record_property
     def publisher_names(self):
         return [strip_end_punctuation(f['b']) for f in self.get_fields('260') if f['b']]
     
-    @property
+    @record_property
     def pub_dates(self):
         return [f.format_field() for f in self.get_fields('362')]
 
-    @property
+    @record_property
     def pub_frequency(self):
         return self['310'].format_field() if self['310'] else ''
 
-    @property
+    @record_property
     def former_pub_frequencies(self):
         return [f.format_field() for f in self.get_fields('321')]
 
-    @property
+    @record_property
     def series(self):
         for field in ('490','440'):
             return [f.format_field() for f in self.get_fields(field)]
         return []
 
-    @property
+    @record_property
     def series_main(self):
         return [f.format_field() for f in self.get_fields('760')]
     
-    @property
+    @record_property
     def statement_of_responsibility(self):
         return strip_end_punctuation(self['245']['c']) if self['245']['c'] else ''
     
-    @property
+    @record_property
     def subjects(self):
         return [f.format_field() for f in self.get_fields('650')]
 
-    @property
+    @record_property
     def summary(self):
         return " ".join([f.format_field() for f in self.get_fields('520')])
 
-    @property
+    @record_property
     def supplements(self):
         return [f.format_field() for f in self.get_fields('770')]
 
-    @property
+    @record_property
     def supplement_parents(self):
         return [f.format_field() for f in self.get_fields('772')]
     
-    @property
+    @record_property
     def title(self):        
         t = self['245']['a'] if self['245']['a'] else ''
         t = "%s %s" % (t, self['245']['b']) if self['245']['b'] else t
         t = "%s %s" % (t, self['245']['p']) if self['245']['p'] else t
         return strip_end_punctuation(t)
     
-    @property
+    @record_property
     def title_varying_forms(self):
         return [f.format_field() for f in self.get_fields('246')]
 
-    @property
+    @record_property
     def title_abbrv(self):
         return [f.format_field() for f in self.get_fields('210')]
 
-    @property
+    @record_property
     def title_key(self):
         return [f.format_field() for f in self.get_fields('222')]
 
-    @property
+    @record_property
     def title_uniform_related(self):
         return [f.format_field() for f in self.get_fields('730')]
 
-    @property
+    @record_property
     def title_uniform(self):
         return self['130'].format_field() if self['130'] else ''
 
@@ -389,58 +545,250 @@ class Record(Record):
         The algorithm to calculate check digits is found at the following URL:
         http://csdirect.iii.com/manual/rmil_records_numbers.html
         """
-        if not self.bibnumber:
-            return None
-        else:        
-            total = 0
-            multiplier = 2
-            for i in reversed(self.bibnumber[1:]):
-                i = int(i)
-                assert 0 <= i <= 9
-                i *= multiplier
-                total += i
-                multiplier += 1
-            dig = total % 11
-            return str(dig) if dig != 10 else 'x'
+        return check_digit(self.bibnumber)
+    
+    def as_dict(self, keys=None):
+        r"""
+        Returns the record as an ordered dict with the keys in DICT_KEYS, or 
+        just the given keys. Only the properties needed for the requested 
+        keys are computed. Besides DICT_KEYS, any Record attribute name 
+        (e.g. 'statement_of_responsibility' or 'raw') can be requested.
+        
+        >>> reader = Reader('http://opac.uthsc.edu', 2)
+        >>> record = reader.decode_record("LEADER 00000cas  2200517 a 4500 \n022    0003-3995 \n245 00 Annales de genetique. ")
+        >>> record.as_dict(['title', 'issn'])
+        OrderedDict([('title', 'Annales de genetique'), ('issn', ['0003-3995'])])
+        """
+        if keys is None:
+            keys = [key for key, attr in self.DICT_KEYS]
+        attrs = dict(self.DICT_KEYS)
+        
+        values = OrderedDict()
+        for key in keys:
+            attr = attrs.get(key, key)
+            if not hasattr(self.__class__, attr) and attr not in self.INSTANCE_ATTRS:
+                raise ValueError("Unknown record field: %s" % (key,))
+            value = getattr(self, attr)
+            if isinstance(value, list):
+                # Copy so callers can't change cached property values
+                value = [dict(v) if isinstance(v, dict) else v for v in value]
+            values[key] = value
+        return values
     
     def __dict__(self):
-        return {
-            'bibnumber': self.bibnumber,
-            'check_digit': self.check_digit,
-            'call_number': self.call_number,
-            'src_host': self.src_host,
-            'record_url': self.record_url,
-            'record_marc_url': self.record_marc_url,
-            'type': self.type,
-            'title': self.title,
-            'issn': self.issn,
-            'isbn': self.isbn,
-            'publishers': self.publishers,
-            'publisher_names': self.publisher_names,
-            'author': self.author,
-            'links': [{'label': link['label'], 'url': link['url']} for link in self.links],
-            'author_name': self.author_name,
-            'author_dates': self.author_dates,
-            'other_authors': [a for a in self.other_authors],
-            'title_uniform': self.title_uniform,
-            'title_abbrv': self.title_abbrv,
-            'title_key': self.title_key,
-            'title_varying_forms': self.title_varying_forms,
-            'edition': self.edition,
-            'comp_file_characteristics': self.comp_file_characteristics,
-            'physical_description': self.physical_description,
-            'pub_frequency': self.pub_frequency,
-            'former_pub_frequencies': self.former_pub_frequencies,
-            'pub_dates': self.pub_dates,
-            'series': self.series,
-            'notes': [n for n in self.notes],
-            'summary': self.summary,
-            'contents': self.contents,
-            'subjects': [s for s in self.subjects],
-            'preceding_titles': [{'title': ep['title'], 'issn': ep['issn'], 'rel': ep['rel']} for ep in self.entry_preceding],
-            'succeeding_titles': [{'title': ep['title'], 'issn': ep['issn'], 'rel': ep['rel']} for ep in self.entry_succeeding],
-            'entry_notes': [en for en in self.entry_notes]
-        }
+        return dict(self.as_dict())
+
+
+class RecordStore(object):
+    r"""
+    Compact in-memory store for large numbers of decoded records, e.g. to 
+    hold a whole harvest for deduplication. Rather than a pymarc object 
+    graph per record, field data is packed into one shared buffer and 
+    described by arrays of offsets, interned tag numbers and indicators. 
+    Records are read back through CompactRecord views, which have the same 
+    accessors as Record and only build pymarc Fields for the tags that 
+    are asked for. Record.raw isn't kept.
+    
+    >>> reader = Reader('http://opac.uthsc.edu', 2)
+    >>> store = RecordStore()
+    >>> view = store.add(reader.decode_record("LEADER 00000cas  2200517 a 4500 \n022    0003-3995 \n245 00 Annales de genetique. "))
+    >>> print view.title, view.issn, view.type
+    Annales de genetique ['0003-3995'] SER
+    >>> print store[0]['245']
+    =245  \0$aAnnales de genetique.
+    >>> len(store)
+    1
+    """
+    
+    def __init__(self):
+        self._buffer = bytearray()
+        self._field_offsets = array.array('L', [0])
+        self._field_tags = array.array('H')
+        self._field_indicators = bytearray()
+        self._record_fields = array.array('L', [0])
+        self._leaders = bytearray()
+        self._leader_offsets = array.array('L', [0])
+        self._bibnumbers = array.array('L')
+        self._record_sources = array.array('H')
+        # Interned tags and (src_host, record_url, record_marc_url) sources
+        self._tags = []
+        self._tag_ids = {}
+        self._sources = []
+        self._source_ids = {}
+    
+    def __len__(self):
+        return len(self._bibnumbers)
+    
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RecordStore index out of range")
+        return CompactRecord(self, index)
+    
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield CompactRecord(self, index)
+    
+    def add(self, record):
+        r"""Packs record (an iiitools.Record) into the store and returns its view."""
+        for field in record.fields:
+            tag_id = self._tag_ids.get(field.tag)
+            if tag_id is None:
+                tag_id = self._tag_ids[field.tag] = len(self._tags)
+                self._tags.append(field.tag)
+            self._field_tags.append(tag_id)
+            if field.is_control_field():
+                self._field_indicators += '  '
+                self._buffer += field.data
+            else:
+                self._field_indicators += field.indicator1[:1] or ' '
+                self._field_indicators += field.indicator2[:1] or ' '
+                # Codes and values alternate, so the list splits back exactly
+                self._buffer += SUBFIELD_DELIMITER.join(field.subfields)
+            self._field_offsets.append(len(self._buffer))
+        self._record_fields.append(len(self._field_tags))
+        
+        self._leaders += str(record.leader)
+        self._leader_offsets.append(len(self._leaders))
+        
+        bibnumber = record.bibnumber
+        self._bibnumbers.append(int(bibnumber[1:]) if bibnumber else 0)
+        # URLs are stored with the bib number cut out, so they intern well
+        source = (record.src_host, 
+                  tuple(record.record_url.split(bibnumber)) if bibnumber else (record.record_url,), 
+                  tuple(record.record_marc_url.split(bibnumber)) if bibnumber else (record.record_marc_url,))
+        source_id = self._source_ids.get(source)
+        if source_id is None:
+            source_id = self._source_ids[source] = len(self._sources)
+            self._sources.append(source)
+        self._record_sources.append(source_id)
+        return CompactRecord(self, len(self) - 1)
+    
+    def extend(self, records):
+        r"""Adds each record in records, skipping Nones."""
+        for record in records:
+            if record is not None:
+                self.add(record)
+    
+    def _field(self, position):
+        tag = self._tags[self._field_tags[position]]
+        data = str(self._buffer[self._field_offsets[position]:self._field_offsets[position + 1]])
+        indicators = [chr(self._field_indicators[2 * position]), 
+                      chr(self._field_indicators[2 * position + 1])]
+        if is_control_tag(tag):
+            return Field(tag=tag, indicators=indicators, data=data)
+        return Field(tag=tag, indicators=indicators, 
+                     subfields=data.split(SUBFIELD_DELIMITER) if data else [])
+
+SUBFIELD_DELIMITER = '\x1f'
+
+
+class CompactRecord(object):
+    r"""
+    View of one record in a RecordStore. It has the same accessor 
+    properties as Record (title, issn, links, ...), computed on each access 
+    rather than cached, and builds pymarc Fields only for the tags that are 
+    looked up. to_record returns a full iiitools.Record.
+    """
+    __slots__ = ('store', 'index')
+    
+    PRECEEDING_ENTRY_LABELS = Record.PRECEEDING_ENTRY_LABELS
+    SUCCEEDING_ENTRY_LABELS = Record.SUCCEEDING_ENTRY_LABELS
+    ISSN_ISBN_PATTERN = Record.ISSN_ISBN_PATTERN
+    DICT_KEYS = Record.DICT_KEYS
+    INSTANCE_ATTRS = Record.INSTANCE_ATTRS
+    
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+    
+    def _positions(self):
+        return xrange(self.store._record_fields[self.index], 
+                      self.store._record_fields[self.index + 1])
+    
+    @property
+    def leader(self):
+        offsets = self.store._leader_offsets
+        return Leader(str(self.store._leaders[offsets[self.index]:offsets[self.index + 1]]))
+    
+    @property
+    def type(self):
+        return self.leader.type
+    
+    @property
+    def bibnumber(self):
+        num = self.store._bibnumbers[self.index]
+        return 'b%d' % num if num else None
+    
+    @property
+    def raw(self):
+        return None
+    
+    def _source(self, part):
+        source = self.store._sources[self.store._record_sources[self.index]]
+        return (self.bibnumber or '').join(source[part])
+    
+    @property
+    def src_host(self):
+        return self.store._sources[self.store._record_sources[self.index]][0]
+    
+    @property
+    def record_url(self):
+        return self._source(1)
+    
+    @property
+    def record_marc_url(self):
+        return self._source(2)
+    
+    @property
+    def fields(self):
+        return [self.store._field(position) for position in self._positions()]
+    
+    def get_fields(self, *tags):
+        tag_ids = set(self.store._tag_ids.get(tag) for tag in tags)
+        field_tags = self.store._field_tags
+        return [self.store._field(position) for position in self._positions() 
+                if field_tags[position] in tag_ids]
+    
+    def __getitem__(self, tag):
+        tag_id = self.store._tag_ids.get(tag)
+        field_tags = self.store._field_tags
+        for position in self._positions():
+            if field_tags[position] == tag_id:
+                return self.store._field(position)
+        return None
+    
+    def tag_index(self):
+        index = {}
+        for field in self.fields:
+            index.setdefault(field.tag, []).append(field)
+        return index
+    
+    def to_record(self):
+        r"""Returns the record as a full iiitools.Record."""
+        record = Record()
+        record.leader = str(self.leader)
+        record.add_field(*self.fields)
+        record.parse_leader()
+        record.bibnumber = self.bibnumber
+        record.src_host = self.src_host
+        record.record_url = self.record_url
+        record.record_marc_url = self.record_marc_url
+        return record
+    
+    has_link = Record.has_link.im_func
+    check_digit = Record.check_digit
+    as_dict = Record.as_dict.im_func
+    __dict__ = Record.__dict__['__dict__']
+
+
+# Record's accessors work on CompactRecord too, just without the caching
+for _name, _value in vars(Record).items():
+    if isinstance(_value, record_property):
+        setattr(CompactRecord, _name, 
+                property(getattr(_value.func, 'im_func', _value.func), doc=_value.__doc__))
+del _name, _value
 
 
 class Reader(object):
@@ -452,17 +800,113 @@ class Reader(object):
     URI_FOR_MARC = Template('$host/search~S$scope?/.$bibnum/.$bibnum/1%2C1%2C1%2CB/marc~$bibnum')
     URI_FOR_HOLDINGS = Template('$host/search~S$scope/.$bibnum/.$bibnum/1,1,1,B/holdings')
     MARC_REGEX = re.compile(r'<pre>(.*)</pre>', re.DOTALL)
+    NOT_FOUND_MARKER = 'No Such Record'
+    IMAP_WINDOW = 2 # Calls in flight per worker thread in _imap
     
-    def __init__(self, opac_host, scope=''):        
+    def __init__(self, opac_host, scope='', optimistic=False, cache=None, 
+                 record_cache=None, stream_marc=False, scheduler=None, 
+                 metrics=None, session=None):
+        r"""
+        If optimistic is True, get_record and get_items_for_record skip the 
+        separate record_exists request and go straight for the MARC or 
+        holdings page, treating a missing record as detected from that 
+        response instead. This halves the number of requests per record.
+        
+        cache is an optional PageCache that get_page consults before going 
+        to the network. record_cache is an optional RecordCache of decoded 
+        records used by get_record.
+        
+        If stream_marc is True, get_record reads MARC pages with 
+        stream_marc_data, which keeps only the <pre> block and hangs up as 
+        soon as it has been received. Streaming is skipped when a page cache 
+        is in use, since the cache needs whole pages.
+        
+        scheduler is an optional RequestScheduler that paces get_page 
+        requests, retries failures and raises RequestError instead of 
+        returning None once retries are exhausted.
+        
+        metrics is an optional Metrics that's given per-phase timings 
+        (exists, marc_fetch, marc_extract, decode, parse_leader, 
+        holdings_fetch, holdings_parse) and counters (requests, 
+        bytes_received, cache hits and misses, errors). Without one, each 
+        phase costs a single extra check.
+        
+        session is an optional SessionManager for patron-scoped access. 
+        Requests then go through its pool of logged-in connections, which 
+        can be shared by several Readers and worker threads.
+        """
         self.host = opac_host
         self.scope = scope
-        self.conn = httplib2.Http()    
+        self.optimistic = optimistic
+        self.cache = cache
+        self.record_cache = record_cache
+        self.stream_marc = stream_marc
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.session = session
+        self._local = threading.local()
+    
+    @property
+    def conn(self):
+        r"""
+        Returns the httplib2.Http connection for the calling thread. 
+        httplib2.Http isn't thread-safe, so each worker thread used by 
+        crawl_records gets its own keep-alive connection.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            timeout = self.scheduler.timeout if self.scheduler else None
+            conn = self._local.conn = httplib2.Http(timeout=timeout)
+        return conn
+    
+    def _timed(self, phase, func, *args):
+        r"""Calls func(*args), timing it as phase if metrics are enabled."""
+        if self.metrics is None:
+            return func(*args)
+        return self.metrics.timed(phase, func, *args)
+    
+    def _count(self, counter, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(counter, value)
     
     def get_page(self, url):
-        resp, content = self.conn.request(url)
-        if resp.status < 400:
+        entry = None
+        headers = {}
+        if self.cache is not None:
+            entry = self.cache.lookup(url)
+            if entry is None:
+                self._count('page_cache_misses')
+            else:
+                if entry['fresh']:
+                    self._count('page_cache_hits')
+                    return entry['content']
+                # Stale, so ask the server whether our copy is still good
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+        
+        if self.session is not None:
+            request = lambda: self.session.request(url, headers=headers)
+        else:
+            request = lambda: self.conn.request(url, headers=headers)
+        if self.scheduler is not None:
+            resp, content = self.scheduler.call(self.host, request)
+        else:
+            resp, content = request()
+        if self.metrics is not None:
+            self.metrics.incr('requests')
+            self.metrics.incr('bytes_received', len(content))
+        if resp.status == 304 and entry is not None:
+            self.cache.revalidated(url)
+            return entry['content']
+        elif resp.status < 400:
+            if self.cache is not None:
+                self.cache.store(url, content, resp.get('etag'), 
+                                 resp.get('last-modified'))
             return content
         else:
+            self._count('http_errors')
             return None            
     
     def record_exists(self, bibnumber):
@@ -475,14 +919,24 @@ class Reader(object):
         >>> reader.record_exists('bz1012752')
         False
         """
-        record_page = self.get_page(self.URI_FOR_RECORD.substitute(host=self.host, bibnum=bibnumber, scope=self.scope))
-        if record_page and record_page.find('No Such Record') == -1:
+        url = self.URI_FOR_RECORD.substitute(host=self.host, bibnum=bibnumber, scope=self.scope)
+        record_page = self._timed('exists', self.get_page, url)
+        return self._is_record_page(record_page)
+    
+    def _is_record_page(self, page):
+        r"""
+        Returns False if page is empty or WebPac's 'No Such Record' page.
+        """
+        if page and page.find(self.NOT_FOUND_MARKER) == -1:
             return True
         else:
             return False
     
-    def get_record(self, bibnumber):
+    def get_record(self, bibnumber, tags=None):
         r"""
+        tags optionally limits which fields are decoded (see decode_record). 
+        Such partial records bypass the record cache.
+        
         >>> reader = Reader('http://opac.uthsc.edu')
         >>> record = reader.get_record('b1012752')
         >>> print record.title
@@ -495,106 +949,527 @@ class Reader(object):
         if not bibnumber.startswith('b'):
             raise ValueError("Invalid bib record number.")
         
-        if self.record_exists(bibnumber):
-            record_page = self.get_page(self.URI_FOR_MARC.substitute(host=self.host, bibnum=bibnumber, scope=self.scope))
-            record_data = re.findall(self.MARC_REGEX, record_page)[0]
-            record = self.decode_record(record_data)
-            if record:
-                # Store relevant system data in record object
-                record.bibnumber = bibnumber
-                record.raw = record_data.decode('latin1')
-                record.src_host = self.host
-                record.record_url = self.URI_FOR_RECORD.substitute(host=self.host, bibnum=bibnumber, scope=self.scope)
-                record.record_marc_url = self.URI_FOR_MARC.substitute(host=self.host, bibnum=bibnumber, scope=self.scope)
-            return record
-        else:
+        use_cache = self.record_cache is not None and tags is None
+        if use_cache:
+            record = self.record_cache.get((self.host, self.scope, bibnumber))
+            if record is not None:
+                self._count('record_cache_hits')
+                return record
+            self._count('record_cache_misses')
+        
+        record_data = self.get_record_data(bibnumber)
+        if record_data is None:
+            return None
+        record = self.make_record(bibnumber, record_data, tags)
+        if record and use_cache:
+            self.record_cache.set((self.host, self.scope, bibnumber), record)
+        return record
+    
+    def get_record_data(self, bibnumber):
+        r"""
+        Returns the undecoded proto-MARC text (what ends up in Record.raw) 
+        for bibnumber, or None if the record doesn't exist.
+        """
+        return self._find_record_data(bibnumber)[0]
+    
+    def _find_record_data(self, bibnumber):
+        r"""
+        Returns (record data, missing) for bibnumber, where missing is True 
+        only if WebPac said there's no such record. Failed requests (without 
+        a scheduler to raise RequestError) give (None, False).
+        """
+        if not self.optimistic:
+            url = self.URI_FOR_RECORD.substitute(host=self.host, bibnum=bibnumber, scope=self.scope)
+            record_page = self._timed('exists', self.get_page, url)
+            if not record_page:
+                return None, False
+            if not self._is_record_page(record_page):
+                return None, True
+        marc_url = self.URI_FOR_MARC.substitute(host=self.host, bibnum=bibnumber, scope=self.scope)
+        if self.stream_marc and self.cache is None:
+            record_data, marker = self._timed('marc_fetch', self._stream_marc, marc_url)
+            return record_data, marker == self.NOT_FOUND_MARKER
+        record_page = self._timed('marc_fetch', self.get_page, marc_url)
+        if not record_page:
+            return None, False
+        if not self._is_record_page(record_page):
+            return None, True
+        return self._timed('marc_extract', self.extract_marc, record_page), False
+    
+    def make_record(self, bibnumber, record_data, tags=None):
+        r"""
+        Decodes record_data (see get_record_data), keeping only tags if 
+        given, and fills in the record's bibnumber, raw text and source URLs.
+        """
+        record = self.decode_record(record_data, tags)
+        if record:
+            # Store relevant system data in record object. raw shares 
+            # the decoded text rather than holding another copy.
+            record.bibnumber = bibnumber
+            record.raw = record_data
+            record.src_host = self.host
+            record.record_url = self.URI_FOR_RECORD.substitute(host=self.host, bibnum=bibnumber, scope=self.scope)
+            record.record_marc_url = self.URI_FOR_MARC.substitute(host=self.host, bibnum=bibnumber, scope=self.scope)
+        return record
+    
+    def iter_changes(self, bib_start, bib_end, state, workers=1, 
+                     block_size=1000):
+        r"""
+        Incremental harvest: yields (status, bibnumber, record) for records 
+        between bib_start and bib_end (inclusive) that are 'new', 'changed' 
+        or 'deleted' (record is None) since the last run recorded in state, 
+        a HarvestState. Unchanged records are recognised by a hash of their 
+        raw text and aren't decoded. 
+        
+        The range is worked through in blocks of block_size bib numbers, 
+        starting with blocks never harvested before and then those whose 
+        records changed most recently (by their 005 field), as they're the 
+        most likely to have changed again.
+        
+        Records are only reported deleted when WebPac says there's no such 
+        record. A bib number whose request fails is skipped and left as it 
+        was in state, to be looked at again on the next run (with a 
+        scheduler, RequestError is raised instead).
+        
+        >>> class FakeReader(Reader):
+        ...     def get_page(self, url):
+        ...         return pages.get(url.rsplit('~', 1)[1]) # None, as for an HTTP error
+        >>> pages = {'b1': "<pre>LEADER 00000nam  2200205 a 4500 \n005    20100101000000.0 \n245 10 First.</pre>", 
+        ...          'b2': "<pre>LEADER 00000nam  2200205 a 4500 \n005    20100101000000.0 \n245 10 Second.</pre>", 
+        ...          'b3': "<html>No Such Record</html>"}
+        >>> state = HarvestState(':memory:')
+        >>> reader = FakeReader('http://opac.uthsc.edu', optimistic=True)
+        >>> [(s, b) for s, b, r in reader.iter_changes('b1', 'b3', state)]
+        [('new', 'b1'), ('new', 'b2')]
+        >>> pages['b2'] = pages['b2'].replace('2010', '2011')
+        >>> pages['b1'] = "<html>No Such Record</html>"
+        >>> [(s, b) for s, b, r in reader.iter_changes('b1', 'b3', state)]
+        [('deleted', 'b1'), ('changed', 'b2')]
+        >>> list(reader.iter_changes('b1', 'b3', state))
+        []
+        >>> b2 = pages.pop('b2') # The request fails
+        >>> list(reader.iter_changes('b1', 'b3', state))
+        []
+        >>> pages['b2'] = b2
+        >>> list(reader.iter_changes('b1', 'b3', state))
+        []
+        """
+        bibnums = bib_range(bib_start, bib_end)
+        blocks = [bibnums[i:i + block_size] for i in range(0, len(bibnums), block_size)]
+        start = int(bib_start[1:])
+        latest = state.latest_changes(start, int(bib_end[1:]), block_size)
+        # Unharvested blocks first, then by most recent 005, newest first
+        block_key = lambda block: latest.get((int(block[0][1:]) - start) // block_size)
+        blocks.sort(key=lambda block: block_key(block) or '', reverse=True)
+        blocks.sort(key=lambda block: block_key(block) is not None)
+        
+        fetch = lambda bibnumber: (bibnumber, self._find_record_data(bibnumber))
+        for block in blocks:
+            known = state.get_many(block)
+            for bibnumber, (record_data, missing) in self._imap(fetch, block, workers):
+                if record_data is None and not missing:
+                    continue
+                previous = known.get(bibnumber)
+                record = None
+                if record_data is not None:
+                    digest = hashlib.sha1(record_data.encode('utf8')).hexdigest()
+                    if previous and not previous['deleted'] and previous['digest'] == digest:
+                        continue
+                    record = self.make_record(bibnumber, record_data)
+                if record is None:
+                    if previous and not previous['deleted']:
+                        state.mark_deleted(bibnumber)
+                        yield 'deleted', bibnumber, None
+                    continue
+                
+                f005 = record['005'].data if record['005'] else None
+                state.update(bibnumber, f005, digest)
+                if previous and not previous['deleted']:
+                    yield 'changed', bibnumber, record
+                else:
+                    yield 'new', bibnumber, record
+            state.commit()
+    
+    def extract_marc(self, page):
+        r"""
+        Returns the proto-MARC text between the <pre> tags of a MARC page 
+        (the same block MARC_REGEX matches), decoded from latin1, or None if 
+        there isn't one. The block is located by offset and decoded straight 
+        from a memoryview of the page, so it isn't copied first.
+        
+        >>> reader = Reader('http://opac.uthsc.edu', 2)
+        >>> reader.extract_marc('<html><pre>\nLEADER 00000cas\n710 2  Soci\xe9t\xe9 \n</pre></html>')
+        u'\nLEADER 00000cas\n710 2  Soci\xe9t\xe9 \n'
+        >>> print reader.extract_marc('<html>No Such Record</html>')
+        None
+        """
+        start = page.find('<pre>')
+        if start == -1:
+            return None
+        start += len('<pre>')
+        end = page.rfind('</pre>')
+        if end < start:
             return None
+        return codecs.latin_1_decode(memoryview(page)[start:end])[0]
+    
+    def stream_marc_data(self, url, chunk_size=8192, max_redirects=5):
+        r"""
+        Streaming alternative to get_page + extract_marc for MARC pages. The 
+        response is read chunk by chunk: everything before <pre> is 
+        discarded as it arrives, and the connection is closed as soon as 
+        the first </pre> turns up, without reading the rest of the page. 
+        Returns the decoded <pre> block, or None for errors and pages 
+        without one (e.g. 'No Such Record').
+        
+        Each call uses its own connection, since hanging up early means it 
+        can't be reused. With a session, requests go through 
+        SessionManager.call, which holds one of its connection slots and 
+        renews an expired session.
+        """
+        return self._stream_marc(url, chunk_size, max_redirects)[0]
+    
+    def _stream_marc(self, url, chunk_size=8192, max_redirects=5):
+        r"""
+        stream_marc_data, returning (<pre> block, marker), where marker is 
+        NOT_FOUND_MARKER for WebPac's 'No Such Record' page.
+        """
+        headers = {'Connection': 'close'}
+        if self.session is None:
+            markers = (self.NOT_FOUND_MARKER,)
+            request = lambda: self._stream_request(url, headers, markers, 
+                                                   chunk_size, max_redirects)
+        else:
+            markers = (self.NOT_FOUND_MARKER, self.session.LOGIN_FORM_MARKER)
+            stream = lambda session_headers: self._stream_request(
+                url, dict(headers, **session_headers), markers, chunk_size, max_redirects)
+            # The login form is the only part of an expired session's page 
+            # that's kept
+            request = lambda: self.session.call(
+                stream, page=lambda content: content[1] or '')
+        if self.scheduler is not None:
+            resp, content = self.scheduler.call(self.host, request)
+        else:
+            resp, content = request()
+        self._count('requests')
+        if resp.status >= 400:
+            self._count('http_errors')
+        return content
+    
+    def _stream_request(self, url, headers, markers, chunk_size, max_redirects):
+        r"""
+        Makes one streamed request for stream_marc_data, following 
+        redirects, and returns (response, (<pre> block, marker)), where 
+        marker is whichever of markers was found before any <pre> (both are 
+        None if there's neither). The body isn't read for error responses, 
+        so the scheduler can retry them.
+        """
+        kwargs = {}
+        if self.scheduler is not None and self.scheduler.timeout:
+            kwargs['timeout'] = self.scheduler.timeout
+        for i in range(max_redirects + 1):
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, **kwargs)
+            else:
+                conn = httplib.HTTPConnection(netloc, **kwargs)
+            try:
+                conn.request('GET', "%s?%s" % (path, query) if query else path, 
+                             headers=headers)
+                resp = conn.getresponse()
+                if resp.status in (301, 302, 303, 307) and resp.getheader('location'):
+                    url = urlparse.urljoin(url, resp.getheader('location'))
+                    continue
+                if resp.status >= 400:
+                    return resp, (None, None)
+                return resp, self._read_pre_block(resp, chunk_size, markers)
+            finally:
+                conn.close()
+        # Too many redirects
+        return resp, (None, None)
+    
+    def _read_pre_block(self, resp, chunk_size, markers):
+        # Enough of the previous chunk to spot a marker split across chunks
+        keep = max([len(marker) for marker in markers] + [len('</pre>')]) - 1
+        head = ''
+        parts = None
+        tail = ''
+        while True:
+            chunk = self._read_some(resp, chunk_size)
+            if not chunk:
+                return None, None
+            if parts is None:
+                head += chunk
+                start = head.find('<pre>')
+                if start == -1:
+                    for marker in markers:
+                        if head.find(marker) != -1:
+                            return None, marker
+                    head = head[-keep:]
+                    continue
+                parts = []
+                chunk = head[start + len('<pre>'):]
+            data = tail + chunk
+            end = data.find('</pre>')
+            if end != -1:
+                parts.append(data[:end])
+                return ''.join(parts).decode('latin1'), None
+            parts.append(data[:-keep])
+            tail = data[-keep:]
+    
+    def _read_some(self, resp, size):
+        r"""
+        Reads up to size bytes of the response body, returning early at the 
+        end of a line. resp.read(size) would block until size bytes have 
+        arrived, which can be long after </pre> was sent.
+        """
+        if resp.chunked:
+            data = resp.read(size)
+            self._count('bytes_received', len(data))
+            return data
+        if resp.length is not None:
+            size = min(size, resp.length)
+            if size <= 0:
+                return ''
+        data = resp.fp.readline(size)
+        if resp.length is not None:
+            resp.length -= len(data)
+        self._count('bytes_received', len(data))
+        return data
     
-    def crawl_records(self, bib_start, bib_end):
+    def invalidate_record(self, bibnumber):
+        r"""Drops bibnumber from the record cache, if there is one."""
+        if self.record_cache is not None:
+            self.record_cache.invalidate((self.host, self.scope, bibnumber))
+    
+    def crawl_records(self, bib_start, bib_end, workers=1, ordered=True):
         r"""
+        Retrieves all existing records between bib_start and bib_end 
+        (inclusive). With workers > 1 the records are fetched concurrently 
+        by a pool of threads, each with its own connection. If ordered is 
+        False, records are returned in the order they complete rather than 
+        in bib number order.
+        
         >>> reader = Reader('http://opac.uthsc.edu', 2)
         >>> records = reader.crawl_records('b1053852', 'b1053862')
         >>> len(records)
         9
         >>> records[0].title
         'Molecular biology of the cell / Bruce Alberts ... [et  al.] ; with problems by John Wilson, Tim Hunt'
+        >>> records = reader.crawl_records('b1053852', 'b1053862', workers=4)
+        >>> len(records)
+        9
         """
-        if not bib_start.startswith('b') or not bib_end.startswith('b'):
-            raise ValueError("Invalid bib record number(s).")
+        return [record for record in 
+                    self._imap(self.get_record, bib_range(bib_start, bib_end), 
+                               workers, ordered) 
+                if record]
     
-        bib_start = int(bib_start[1:])
-        bib_end = int(bib_end[1:])+1
-        records = []
+    def iter_records(self, bib_start, bib_end, checkpoint=None, 
+                     checkpoint_every=100, workers=1):
+        r"""
+        Generator version of crawl_records, yielding each record (in bib 
+        number order) as soon as it's decoded. 
+        
+        If checkpoint is a file path, the last bib number handled is written 
+        to it every checkpoint_every bib numbers and when the crawl finishes. 
+        A bib number is only committed once the record for it has been 
+        consumed, and if the file already exists the crawl resumes after the 
+        bib number it holds.
         
-        for num in range(bib_start, bib_end):
-            bibnum = "b%s" % (num,)
-            record = self.get_record(bibnum)
+        >>> reader = Reader('http://opac.uthsc.edu', 2)
+        >>> records = reader.iter_records('b1053852', 'b1053862')
+        >>> records.next().title
+        'Molecular biology of the cell / Bruce Alberts ... [et  al.] ; with problems by John Wilson, Tim Hunt'
+        """
+        bibnums = bib_range(bib_start, bib_end)
+        if checkpoint:
+            last = read_checkpoint(checkpoint)
+            if last:
+                last = int(last[1:])
+                bibnums = [b for b in bibnums if int(b[1:]) > last]
+        
+        fetch = lambda bibnum: (bibnum, self.get_record(bibnum))
+        processed = 0
+        bibnum = None
+        for bibnum, record in self._imap(fetch, bibnums, workers):
             if record:
-                records.append(record)
-        return records    
+                yield record
+            processed += 1
+            if checkpoint and processed % checkpoint_every == 0:
+                write_checkpoint(checkpoint, bibnum)
+        if checkpoint and bibnum:
+            write_checkpoint(checkpoint, bibnum)
+    
+    def _imap(self, func, args, workers=1, ordered=True):
+        r"""
+        Yields func(arg) for each item in args, using a pool of worker 
+        threads when workers > 1. Only IMAP_WINDOW calls per worker are 
+        submitted ahead of the consumer, so a slow consumer (or one that 
+        stops early) doesn't set off the whole range.
+        """
+        if workers <= 1:
+            for arg in args:
+                yield func(arg)
+            return
+        
+        window = workers * self.IMAP_WINDOW
+        pool = ThreadPool(workers)
+        try:
+            if ordered:
+                pending = deque()
+                for arg in args:
+                    pending.append(pool.apply_async(func, (arg,)))
+                    if len(pending) >= window:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+            else:
+                done = Queue.Queue()
+                def call(arg):
+                    try:
+                        done.put((func(arg), None))
+                    except Exception:
+                        done.put((None, sys.exc_info()))
+                def next_done():
+                    result, error = done.get()
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    return result
+                pending = 0
+                for arg in args:
+                    pool.apply_async(call, (arg,))
+                    pending += 1
+                    if pending >= window:
+                        pending -= 1
+                        yield next_done()
+                while pending:
+                    pending -= 1
+                    yield next_done()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
     
-    def decode_record(self, record):
+    def decode_record(self, record, tags=None):
         r"""
+        Decodes WebPac proto-MARC text into an iiitools.Record, or returns 
+        None if it isn't a record or has no title. The text is handled in a 
+        single pass over its lines: it's transcoded from latin1 to utf8 once 
+        and entities are only unescaped on lines that contain them.
+        
+        tags limits decoding to the given tags, either a collection of tags 
+        or a function taking a tag and returning whether to keep it. Lines 
+        of other fields (with their continuation lines) are skipped before 
+        any unescaping or subfield splitting. The leader is always kept, and 
+        the title check only applies if 245 is kept.
+        
         >>> reader = Reader('http://opac.uthsc.edu', 2)
         >>> raw = "\nLEADER 00000cas  2200517 a 4500 \n001    1481253 \n003    OCoLC \n005    19951109120000.0 \n008    750727c19589999fr qrzp   b   0   b0fre d \n010    sn 86012727 \n022    0003-3995 \n030    AGTQAH \n035    0062827|bMULS|aPITT  NO.  0639600000|asa64872000|bFULS \n040    MUL|cMUL|dFUL|dOCL|dCOO|dNYG|dHUL|dSER|dAIP|dNST|dAGL|dDLC\n       |dTUM \n041 0  engfre|bgeritaspa \n042    nsdp \n049    TUMS \n069 1  A32025000 \n210 0  Ann. genet. \n222  0 Annales de genetique \n229 00 Annales de genetique \n229    Ann Genet \n242 00 Annals on genetics \n245 00 Annales de genetique. \n260    Paris :|bExpansion scientifique,|c1958-2004. \n300    v. :|bill. &#59;|c28 cm. \n310    Quarterly \n321    Two no. a year \n362 0  1,1958-47,2004. \n510 1  Excerpta medica \n510 1  Index medicus|x0019-3879 \n510 2  Biological abstracts|x0006-3169 \n510 2  Chemical abstracts|x0009-2258 \n510 2  Life sciences collection \n510 0  Bulletin signaletique \n510 0  Current contents \n546    French and English, with summaries in German, Italian, and\n       Spanish. \n550    Journal of the Societe francaise de genetique. \n650  2 Genetics|vPeriodicals. \n710 2  Societ\xe9 fran\xe7aise de genetique. \n785 00 |tEuropean journal of medical genetics.  \n856 41 |uhttp://library.uthsc.edu/ems/eresource/3581|zFull text \n       at ScienceDirect: 43(1) Jan 2000 - 47(4) Dec 2004 \n936    Unknown|ajuin 1977 \n"
         >>> record = reader.decode_record(raw)
         >>> print record.title
         Annales de genetique
+        >>> record = reader.decode_record(raw, tags=['022', '245', '546'])
+        >>> print record.title, record.issn, record.type, len(record.fields)
+        Annales de genetique ['0003-3995'] SER 3
+        >>> print record['546']
+        =546  \\$aFrench and English, with summaries in German, Italian, and Spanish.
+        >>> [f.tag for f in reader.decode_record(raw, lambda tag: tag.startswith('5')).fields]
+        ['510', '510', '510', '510', '510', '510', '510', '546', '550']
         """
-        
-        pseudo_marc = record.strip().split('\n')
-        raw_fields = []
-        if pseudo_marc[0][0:6] == 'LEADER':
-            record = Record()
-            record.leader = pseudo_marc[0][7:].strip()
+        if self.metrics is not None:
+            return self.metrics.timed('decode', self._decode_record, record, tags)
+        return self._decode_record(record, tags)
+    
+    def _decode_record(self, record, tags=None):
+        if isinstance(record, unicode):
+            record = record.encode('utf8')
         else:
+            record = record.decode('latin1').encode('utf8')
+        
+        lines = record.strip().split('\n')
+        if lines[0][0:6] != 'LEADER':
             return None
-
-        for field in pseudo_marc[1:]:
-            tag = field[:3]
-            data = unescape_entities(field[6:].decode('latin1')).encode('utf8')
-
-            if tag.startswith(' '):
-                # Additional field data needs to be prepended with an extra space 
-                # for certain fields ...
-                #for special_tag in ('55','260'):
-                #    data = " %s" % (data,) if tag.startswith(special_tag) else data
-                data = " %s" % (data.strip(),)
-                raw_fields[-1]['value'] = "%s%s" % (raw_fields[-1]['value'], data)
-                raw_fields[-1]['raw'] = "%s%s" % (raw_fields[-1]['raw'], field.strip())
-            else:
-                data = data if (tag < '010' and tag.isdigit()) else "a%s" % (data,)
-                raw_fields.append({
-                    'tag': tag, 
-                    'indicator1': field[3], 
-                    'indicator2': field[4], 
-                    'value': data.strip(), 
-                    'raw': field.strip()
-                })
         
-        for raw in raw_fields:
-            tag = raw['tag']
-            data = raw['value'].strip()
-            field = Field(tag=tag, indicators=[raw['indicator1'], raw['indicator2']], data=data)
-            if not field.is_control_field():
-                for sub in data.split('|'):
-                    try:
-                        field.add_subfield(sub[0].strip(), sub[1:].strip())
-                    except Exception:
-                        # Skip blank/empty subfields
-                        continue
-            record.add_field(field)
+        decoded = Record()
+        decoded.leader = lines[0][7:].strip()
+        
+        if tags is not None and not callable(tags):
+            tags = frozenset(tags).__contains__
+        
+        # Each field is [tag, indicator1, indicator2, [value parts]]
+        fields = []
+        keep = True
+        for line in lines[1:]:
+            continuation = line[:1] == ' '
+            if tags is not None:
+                if not continuation:
+                    keep = tags(line[:3])
+                if not keep:
+                    continue
             
-        record.parse_leader()
+            data = line[6:]
+            if '&' in data:
+                data = unescape_entities(data.decode('utf8')).encode('utf8')
+            
+            if continuation:
+                # Continuation of the previous field's data
+                fields[-1][3].append(' ' + data.strip())
+            else:
+                tag = line[:3]
+                if is_control_tag(tag):
+                    data = data.strip()
+                else:
+                    data = 'a' + data.rstrip()
+                fields.append([tag, line[3], line[4], [data]])
+        
+        decoded.add_field(*[make_field(tag, indicator1, indicator2, 
+                                       ''.join(parts).strip())
+                            for tag, indicator1, indicator2, parts in fields])
+        
+        self._timed('parse_leader', decoded.parse_leader)
         
         # Disregard record if no title present
-        if not record.get_fields('245'):
+        if (tags is None or tags('245')) and not decoded.get_fields('245'):
             return None
         else:
-            return record
+            return decoded
+    
+    def decode_records(self, records, tags=None):
+        r"""
+        Batch version of decode_record. Yields the decoded record (or None) 
+        for each proto-MARC string in records, keeping only tags if given.
+        
+        >>> reader = Reader('http://opac.uthsc.edu', 2)
+        >>> raws = ["LEADER 00000nam  2200205 a 4500 \n245 10 First.", 
+        ...         "<html>Not MARC</html>", 
+        ...         "LEADER 00000nam  2200205 a 4500 \n245 10 Second."]
+        >>> [r and r.title for r in reader.decode_records(raws)]
+        ['First', None, 'Second']
+        """
+        if tags is not None and not callable(tags):
+            tags = frozenset(tags).__contains__
+        for record in records:
+            yield self.decode_record(record, tags)
     
     def get_items_for_record(self, bibnumber):
         r"""
+        Returns the items on bibnumber's holdings page as dicts, newest 
+        first. If the page links to additional copies, the items come from 
+        that page instead, since it lists all of them.
+        
+        >>> class FakeReader(Reader):
+        ...     def get_page(self, url):
+        ...         return pages[url.endswith('/more')]
+        >>> row = '<tr class="bibItemsEntry"><td>Stacks</td><td>QH 1 .A5 %s</td><td>AVAILABLE</td></tr>'
+        >>> pages = {False: '<table class="bibItems">%s%s</table>' % (row % '', row % '')}
+        >>> reader = FakeReader('http://opac.uthsc.edu', 2, optimistic=True)
+        >>> [item['call_num'] for item in reader.get_items_for_record('b1')]
+        ['QH 1 .A5', 'QH 1 .A5']
+        >>> pages = {False: '<table class="bibItems">%s%s</table><a href="/more">View additional copies</a>' % (row % 'v.1', row % 'v.2'), 
+        ...          True: '<table class="bibItems">%s%s%s</table>' % (row % 'v.1', row % 'v.2', row % 'v.3')}
+        >>> [item['call_num'] for item in reader.get_items_for_record('b1')]
+        ['QH 1 .A5 v.3', 'QH 1 .A5 v.2', 'QH 1 .A5 v.1']
+        
         >>> reader = Reader('http://opac.uthsc.edu', 2)
         >>> items = reader.get_items_for_record('b1012752')
         >>> items[0]
@@ -605,73 +1480,2023 @@ class Reader(object):
         if not bibnumber.startswith('b'):
             raise ValueError("Invalid bib record number.")
         
-        if self.record_exists(bibnumber):
-            from lxml import html
+        if self.optimistic or self.record_exists(bibnumber):
             url = self.URI_FOR_HOLDINGS.substitute(host=self.host, 
                     bibnum=bibnumber, scope=self.scope)
-            record_holdings_page = self.get_page(url)
-            items_data = html.document_fromstring(record_holdings_page)
-            table_rows = items_data.cssselect('.bibItems tr.bibItemsEntry')
-            table_rows.reverse() # Sort from newest to oldest
+            record_holdings_page = self._timed('holdings_fetch', self.get_page, url)
+            if not self._is_record_page(record_holdings_page):
+                return []
+            
+            visited = set([url])
+            while True:
+                parser = HoldingsParser()
+                self._timed('holdings_parse', parser.parse, record_holdings_page)
+                rows = parser.rows
+                # The 'additional copies' page lists all of the items, 
+                # including those on this one
+                if not parser.more_url:
+                    break
+                url = urlparse.urljoin(url, parser.more_url)
+                if url in visited:
+                    break
+                visited.add(url)
+                record_holdings_page = self._timed('holdings_fetch', self.get_page, url)
+                if not record_holdings_page:
+                    break
+            
+            rows.reverse() # Sort from newest to oldest
             items = []
-            for item in table_rows:                
-                if item[1].cssselect('a'):
-                    url = item[1].cssselect('a')[0].get('href').encode('utf8')
-                else:
-                    url = ''
+            for cells in rows:
+                if len(cells) < 3:
+                    continue
                 items.append({
-                    'location': item[0].text_content().strip().encode('utf8'), 
-                    'call_num': item[1].text_content().strip().encode('utf8'), 
-                    'status': item[2].text_content().strip().encode('utf8'),
-                    'url': url
+                    'location': cells[0][0].encode('utf8'), 
+                    'call_num': cells[1][0].encode('utf8'), 
+                    'status': cells[2][0].encode('utf8'),
+                    'url': (cells[1][1] or u'').encode('utf8')
                 })
             return items
         else:
             return []
+    
+    def get_items_for_records(self, bibnumbers, workers=4):
+        r"""
+        Returns an ordered dict of bibnumber => items (see 
+        get_items_for_record), fetching holdings for up to workers records 
+        at a time.
+        
+        >>> reader = Reader('http://opac.uthsc.edu', 2)
+        >>> holdings = reader.get_items_for_records(['b1012752', 'b1053852'])
+        >>> len(holdings['b1012752'])
+        56
+        """
+        fetch = lambda bibnumber: (bibnumber, self.get_items_for_record(bibnumber))
+        return OrderedDict(self._imap(fetch, bibnumbers, workers))
 
-def unescape_entities(text):
+
+class HoldingsParser(object):
     r"""
-    Removes HTML or XML character references and entities from a text string.
-    Keeps &amp;, &gt;, &lt; in the source code. Based on original from Fredrik 
-    Lundh. http://effbot.org/zone/re-sub.htm#unescape-html
-      
-    Note: 'text' must be a Unicode string
+    Fast parser for WebPac holdings pages. Scans the page with a few 
+    regular expressions instead of building a document tree, collecting 
+    the cells of each 'bibItemsEntry' row in the 'bibItems' table as 
+    (text, first link href) pairs, and notes the link to additional 
+    copies, if there is one.
     
-    >>> output = unescape_entities(u'This leads to &raquo; that')
-    >>> print output.encode('utf8')
-    This leads to » that
+    >>> parser = HoldingsParser()
+    >>> parser.parse('<table class="bibItems"><tr class="bibItemsHeader"><th>Location</th></tr>'
+    ...              '<tr class="bibItemsEntry"><td>Journal Collection </td>'
+    ...              '<td><a href="/x">v.47 no.4</a> Oct&#47;Dec 2004</td><td>&nbsp;AVAILABLE</td></tr>'
+    ...              '</table><a href="/more">View additional copies</a>')
+    >>> parser.rows
+    [[(u'Journal Collection', None), (u'v.47 no.4 Oct/Dec 2004', u'/x'), (u'AVAILABLE', None)]]
+    >>> parser.more_url
+    u'/more'
     """
-    def fixup(m):
-        import htmlentitydefs
+    
+    TABLE_REGEX = re.compile(r'<table\b[^>]*\bclass\s*=\s*["\']?[^"\'>]*\bbibItems\b', re.I)
+    ROW_SPLIT_REGEX = re.compile(r'<tr\b', re.I)
+    ROW_CLASS_REGEX = re.compile(r'[^>]*\bclass\s*=\s*["\']?[^"\'>]*\bbibItemsEntry\b[^>]*>', re.I)
+    ROW_END_REGEX = re.compile(r'</tr>|</table>', re.I)
+    CELL_SPLIT_REGEX = re.compile(r'<t[dh]\b[^>]*>', re.I)
+    CELL_END_REGEX = re.compile(r'</t[dh]>', re.I)
+    LINK_REGEX = re.compile(r'<a\b[^>]*?\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))[^>]*>(.*?)</a>', re.I | re.S)
+    HREF_REGEX = re.compile(r'<a\b[^>]*?\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.I)
+    MARKUP_REGEX = re.compile(r'<!--.*?-->|<[^>]*>', re.S)
+    MORE_ITEMS_REGEX = re.compile(r'additional copies', re.I)
+    CHARSET_REGEX = re.compile(r'charset=["\']?([\w-]+)', re.I)
+    
+    def __init__(self):
+        self.rows = []
+        self.more_url = None
+    
+    def parse(self, page):
+        r"""Parses a complete holdings page (bytes or unicode)."""
+        if isinstance(page, str):
+            charset = self.CHARSET_REGEX.search(page, 0, 2048)
+            try:
+                page = page.decode(charset.group(1) if charset else 'latin1')
+            except (LookupError, UnicodeDecodeError):
+                page = page.decode('latin1')
+        
+        table = self.TABLE_REGEX.search(page)
+        if table:
+            # Everything after each '<tr' up to the next one is a row
+            for row in self.ROW_SPLIT_REGEX.split(page[table.start():])[1:]:
+                start = self.ROW_CLASS_REGEX.match(row)
+                if not start:
+                    continue
+                end = self.ROW_END_REGEX.search(row, start.end())
+                row = row[start.end():end.start() if end else len(row)]
+                cells = []
+                for cell in self.CELL_SPLIT_REGEX.split(row)[1:]:
+                    end = self.CELL_END_REGEX.search(cell)
+                    if end:
+                        cell = cell[:end.start()]
+                    link = self.HREF_REGEX.search(cell)
+                    cells.append((self._text(cell), 
+                                  self._href(link) if link else None))
+                self.rows.append(cells)
         
-        text = m.group(0)
-        if text[:2] == "&#":
-            # character reference
+        if not self.MORE_ITEMS_REGEX.search(page):
+            return
+        for link in self.LINK_REGEX.finditer(page):
+            if self.MORE_ITEMS_REGEX.search(self._text(link.group(4))):
+                self.more_url = self._href(link)
+                break
+    
+    def _text(self, html):
+        return unescape_html(self.MARKUP_REGEX.sub(u'', html)).strip()
+    
+    def _href(self, link):
+        href = link.group(1)
+        if href is None:
+            href = link.group(2) if link.group(2) is not None else link.group(3)
+        return unescape_html(href)
+
+
+class AsyncReader(object):
+    r"""
+    Non-blocking counterpart to Reader. record_exists, get_record, 
+    get_items_for_record and crawl_records return immediately with an 
+    AsyncResult (see multiprocessing.pool) and the requests run on a shared 
+    pool of max_concurrency worker threads, each holding a keep-alive 
+    connection. An optional callback is called with the result as soon as 
+    it's ready, which makes it easy to hand results back to an event loop.
+    Any other keyword arguments (e.g. optimistic) are passed on to Reader.
+    
+    >>> reader = AsyncReader('http://opac.uthsc.edu', 2, max_concurrency=8)
+    >>> pending = [reader.get_record(b) for b in ('b1012752', 'b1053852')]
+    >>> print pending[0].get().title
+    Annales de genetique
+    >>> len(reader.crawl_records('b1053852', 'b1053862').get())
+    9
+    >>> reader.close()
+    """
+    
+    def __init__(self, opac_host, scope='', max_concurrency=10, **kwargs):
+        self.reader = Reader(opac_host, scope, **kwargs)
+        self.max_concurrency = max_concurrency
+        self._pool = None
+        self._pool_lock = threading.Lock()
+    
+    host = property(lambda self: self.reader.host)
+    scope = property(lambda self: self.reader.scope)
+    
+    @property
+    def pool(self):
+        r"""Returns the shared worker pool, starting it on first use."""
+        if self._pool is None:
+            self._pool_lock.acquire()
             try:
-                if text[:3] == "&#x":
-                    return unichr(int(text[3:-1], 16))
-                else:
-                    return unichr(int(text[2:-1]))
-            except ValueError:
-                print "Some kind of ValueError encountered ..."
-                pass
+                if self._pool is None:
+                    self._pool = ThreadPool(self.max_concurrency)
+            finally:
+                self._pool_lock.release()
+        return self._pool
+    
+    def close(self):
+        r"""Waits for outstanding requests and shuts down the worker pool."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+    
+    def decode_record(self, record, tags=None):
+        return self.reader.decode_record(record, tags)
+    
+    def record_exists(self, bibnumber, callback=None):
+        return self.pool.apply_async(self.reader.record_exists, (bibnumber,), 
+                                     callback=callback)
+    
+    def get_record(self, bibnumber, callback=None, tags=None):
+        return self.pool.apply_async(self.reader.get_record, (bibnumber, tags), 
+                                     callback=callback)
+    
+    def get_items_for_record(self, bibnumber, callback=None):
+        return self.pool.apply_async(self.reader.get_items_for_record, 
+                                     (bibnumber,), callback=callback)
+    
+    def crawl_records(self, bib_start, bib_end, callback=None):
+        r"""
+        Fetches every record between bib_start and bib_end (inclusive) on 
+        the worker pool. The result is the list of existing records, in bib 
+        number order.
+        """
+        if callback is not None:
+            on_done = lambda records: callback([r for r in records if r])
         else:
-            # named entity
+            on_done = None
+        return _CrawlResult(self.pool.map_async(self.reader.get_record, 
+                                                bib_range(bib_start, bib_end), 
+                                                callback=on_done))
+
+
+class _CrawlResult(object):
+    r"""
+    Wraps the AsyncResult from map_async, dropping the None entries left 
+    by bib numbers that don't exist.
+    """
+    def __init__(self, result):
+        self._result = result
+    
+    def ready(self):
+        return self._result.ready()
+    
+    def successful(self):
+        return self._result.successful()
+    
+    def wait(self, timeout=None):
+        self._result.wait(timeout)
+    
+    def get(self, timeout=None):
+        return [record for record in self._result.get(timeout) if record]
+
+class RequestError(IOError):
+    r"""Raised when a request still fails after all its retries."""
+
+
+class CircuitOpenError(RequestError):
+    r"""Raised when requests to a host are suspended by its circuit breaker."""
+
+
+class RequestScheduler(object):
+    r"""
+    Paces and retries the requests Reader.get_page makes, to get as much 
+    throughput out of a WebPac as it will tolerate:
+    
+    * Token bucket rate limiting: at most rate requests per second on 
+      average, with bursts of up to burst requests.
+    * AIMD concurrency: the number of requests allowed in flight at once 
+      grows by about one per round of fast successes, up to 
+      max_concurrency, and is halved on errors (cut by 10% on responses 
+      slower than target_latency).
+    * Retries: connection errors, timeouts, 5xx and 429 responses are 
+      retried up to max_retries times, with full-jitter exponential backoff 
+      starting at backoff seconds and capped at max_backoff.
+    * Circuit breaker: after failure_threshold consecutive failures, 
+      requests to that host fail fast with CircuitOpenError for 
+      reset_timeout seconds, after which a single trial request is let 
+      through.
+    
+    timeout is the socket timeout used for each request.
+    
+    >>> import httplib2
+    >>> scheduler = RequestScheduler(backoff=0.001)
+    >>> responses = [httplib2.Response({'status': 503}), httplib2.Response({'status': 200})]
+    >>> resp, content = scheduler.call('opac', lambda: (responses.pop(0), 'page'))
+    >>> resp.status, scheduler.stats['retries']
+    (200, 1)
+    """
+    
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    RETRY_ERRORS = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error)
+    
+    def __init__(self, rate=None, burst=None, max_concurrency=8, 
+                 min_concurrency=1, target_latency=2.0, max_retries=3, 
+                 backoff=0.5, max_backoff=30.0, failure_threshold=5, 
+                 reset_timeout=60.0, timeout=30):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 1)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        
+        self.limit = float(min_concurrency)
+        self.active = 0
+        self.stats = dict.fromkeys(('requests', 'retries', 'failures', 
+                                    'rejected'), 0)
+        self._tokens = float(self.burst)
+        self._refilled_at = time.time()
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+        self._circuits = {}
+    
+    def call(self, host, request):
+        r"""
+        Calls request(), which should return an httplib2 (response, content) 
+        pair, with rate limiting, retries and circuit breaking for host.
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._slots.acquire()
+                try:
+                    self.stats['retries'] += 1
+                finally:
+                    self._slots.release()
+                time.sleep(self._backoff_delay(attempt, error))
+            self._check_circuit(host)
+            self._acquire()
+            start = time.time()
             try:
-                if text[1:-1] == "amp":
-                    text = "&amp;amp;"
-                elif text[1:-1] == "gt":
-                    text = "&amp;gt;"
-                elif text[1:-1] == "lt":
-                    text = "&amp;lt;"
-                else:
-                    text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
-            except KeyError:
-                print "keyerror"
-                pass
-        return text # leave as is
-    regex = re.compile(ur'&#?\w+;', re.UNICODE)    
-    return regex.sub(fixup, text)
+                try:
+                    resp, content = request()
+                    error = None
+                except self.RETRY_ERRORS, e:
+                    error = e
+            finally:
+                self._release()
+            
+            if error is None and resp.status not in self.RETRY_STATUSES:
+                self._succeeded(host, time.time() - start)
+                return resp, content
+            if error is None:
+                error = resp
+            self._failed(host)
+        
+        if isinstance(error, Exception):
+            raise RequestError("Request to %s failed: %s" % (host, error))
+        raise RequestError("Request to %s failed with status %s" % (host, error.status))
+    
+    def _backoff_delay(self, attempt, error):
+        delay = random.uniform(0, min(self.max_backoff, 
+                                      self.backoff * 2 ** (attempt - 1)))
+        # Honour Retry-After (in seconds) when the server sends one
+        retry_after = getattr(error, 'get', lambda key: None)('retry-after')
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        return delay
+    
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            while self.active >= int(self.limit):
+                self._slots.wait()
+            self.active += 1
+            self.stats['requests'] += 1
+        finally:
+            self._slots.release()
+        
+        if self.rate:
+            # Token bucket
+            while True:
+                self._lock.acquire()
+                try:
+                    now = time.time()
+                    self._tokens = min(self.burst, self._tokens + 
+                                       (now - self._refilled_at) * self.rate)
+                    self._refilled_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                finally:
+                    self._lock.release()
+                time.sleep(wait)
+    
+    def _release(self):
+        self._slots.acquire()
+        try:
+            self.active -= 1
+            self._slots.notify()
+        finally:
+            self._slots.release()
+    
+    def _set_limit(self, limit):
+        # Caller holds the lock
+        self.limit = max(self.min_concurrency, min(self.max_concurrency, limit))
+        self._slots.notify_all()
+    
+    def _succeeded(self, host, latency):
+        self._slots.acquire()
+        try:
+            if latency <= self.target_latency:
+                self._set_limit(self.limit + 1.0 / self.limit)
+            else:
+                self._set_limit(self.limit * 0.9)
+            self._circuits.pop(host, None)
+        finally:
+            self._slots.release()
+    
+    def _failed(self, host):
+        self._slots.acquire()
+        try:
+            self.stats['failures'] += 1
+            self._set_limit(self.limit / 2)
+            circuit = self._circuits.setdefault(host, {'failures': 0, 'opened_at': None})
+            circuit['failures'] += 1
+            if circuit['failures'] >= self.failure_threshold:
+                circuit['opened_at'] = time.time()
+        finally:
+            self._slots.release()
+    
+    def _check_circuit(self, host):
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit['opened_at'] is None:
+                return
+            if time.time() - circuit['opened_at'] < self.reset_timeout:
+                self.stats['rejected'] += 1
+                raise CircuitOpenError("Circuit open for %s" % (host,))
+            # Half-open: let this request through as a trial and hold 
+            # everything else back until it completes or times out again.
+            circuit['opened_at'] = time.time()
+        finally:
+            self._lock.release()
+
+
+class AuthenticationError(RequestError):
+    r"""Raised when SessionManager can't log in."""
+
+
+class SessionManager(object):
+    r"""
+    Logged-in WebPac patron session shared by Readers (see Reader's session 
+    option). It logs in once, keeps a pool of up to max_connections 
+    keep-alive connections that send the session cookie, and when a 
+    response shows the session has expired (the server hands out a new 
+    session id or shows the login form again) it logs in again and retries 
+    the request. Only one thread logs in at a time; the others wait for 
+    the new session. If max_age is given, sessions older than that many 
+    seconds are renewed before use.
+    
+    >>> class FakeHttp(object):
+    ...     def request(self, url, method='GET', body=None, headers=None):
+    ...         cookie = (headers or {}).get('Cookie')
+    ...         if url.endswith('/patroninfo'):
+    ...             server['logins'] += 1
+    ...             return httplib2.Response({'status': 302}), ''
+    ...         if cookie != 'III_SESSION_ID=%d' % server['session']:
+    ...             server['session'] += 1
+    ...             return (httplib2.Response({'status': 200, 'set-cookie': 'III_SESSION_ID=%d; path=/' % server['session']}), 
+    ...                     '<form><input name="extpatid"></form>')
+    ...         return httplib2.Response({'status': 200}), 'Patron page'
+    >>> class FakeSessionManager(SessionManager):
+    ...     def _connect(self):
+    ...         return FakeHttp()
+    >>> server = {'session': 0, 'logins': 0}
+    >>> session = FakeSessionManager('https://opac.uthsc.edu', 'patron', 'secret', 2)
+    >>> resp, content = session.request('https://opac.uthsc.edu/patroninfo~S2/123/items')
+    >>> content, session.session_id, server['logins']
+    ('Patron page', '1', 1)
+    >>> server['session'] = 5 # Expire it on the server
+    >>> resp, content = session.request('https://opac.uthsc.edu/patroninfo~S2/123/items')
+    >>> content, session.session_id, server['logins']
+    ('Patron page', '7', 2)
+    """
+    
+    SESSION_ID_REGEX = re.compile(r'III_SESSION_ID=(\w+)')
+    LOGIN_FORM_MARKER = 'name="extpatid"'
+    URI_FOR_LOGIN = Template('$host/patroninfo')
+    URI_FOR_SESSION = Template('$host/search~S$scope')
+    
+    def __init__(self, opac_host, username, password, scope='', 
+                 max_connections=8, max_age=None, timeout=30):
+        self.host = opac_host
+        self.username = username
+        self.password = password
+        self.scope = scope
+        self.max_connections = max_connections
+        self.max_age = max_age
+        self.timeout = timeout
+        self.session_id = None
+        self.logged_in_at = None
+        self.stats = dict.fromkeys(('logins', 'requests', 'expired'), 0)
+        self._lock = threading.Lock()
+        self._login_lock = threading.Lock()
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(max_connections)
+    
+    @property
+    def cookie(self):
+        r"""The Cookie header value for the current session."""
+        return 'III_SESSION_ID=%s' % self.login()
+    
+    def login(self, expired_id=None):
+        r"""
+        Returns the current session id, logging in first if there isn't 
+        one yet, it's older than max_age or it's expired_id (a session the 
+        caller found had expired). Raises AuthenticationError if the login 
+        is refused.
+        """
+        self._login_lock.acquire()
+        try:
+            if (self.session_id is not None and self.session_id != expired_id and 
+                (self.max_age is None or time.time() - self.logged_in_at < self.max_age)):
+                return self.session_id
+            
+            http = self._connect()
+            # Get a session id, then log it in with the patron's credentials
+            resp, content = http.request(self.URI_FOR_SESSION.substitute(
+                                             host=self.host, scope=self.scope))
+            session_id = self._session_id(resp)
+            if session_id is None:
+                raise AuthenticationError("No session id from %s" % (self.host,))
+            body = urllib.urlencode([('extpatid', self.username), 
+                                     ('extpatpw', self.password), 
+                                     ('name', ''), ('code', ''), ('pin', ''), 
+                                     ('submit', 'Login')])
+            headers = {'Content-type': 'application/x-www-form-urlencoded', 
+                       'Cookie': 'III_SESSION_ID=%s' % session_id}
+            resp, content = http.request(self.URI_FOR_LOGIN.substitute(host=self.host), 
+                                         'POST', headers=headers, body=body)
+            # WebPac redirects to the patron's record on success
+            if resp.status != 302:
+                raise AuthenticationError("Login to %s failed." % (self.host,))
+            
+            self.session_id = self._session_id(resp) or session_id
+            self.logged_in_at = time.time()
+            self.stats['logins'] += 1
+            return self.session_id
+        finally:
+            self._login_lock.release()
+    
+    def request(self, url, method='GET', body=None, headers=None):
+        r"""
+        Makes a request with the session cookie on a pooled connection 
+        (see call) and returns httplib2's (response, content).
+        """
+        def send(session_headers):
+            all_headers = dict(headers or {})
+            all_headers.update(session_headers)
+            http = self._checkout()
+            try:
+                return http.request(url, method, body=body, headers=all_headers)
+            finally:
+                self._checkin(http)
+        return self.call(send)
+    
+    def call(self, request, page=None):
+        r"""
+        Runs request, a function taking a dict of headers (the session 
+        cookie) and returning (response, content), in one of the 
+        max_connections slots (waiting for one if they're all busy), and 
+        returns its result. If the response shows the session has expired, 
+        the session is renewed and the request run once more. 
+        
+        The response can be httplib2's or httplib's. page, if given, is 
+        applied to content to get the text to look for the login form in, 
+        for requests whose content isn't the page itself.
+        """
+        self._slots.acquire()
+        try:
+            session_id = self.login()
+            resp, content = request({'Cookie': 'III_SESSION_ID=%s' % session_id})
+            expired = self._expired(session_id, resp, 
+                                    page(content) if page else content)
+            if expired:
+                session_id = self.login(session_id)
+                resp, content = request({'Cookie': 'III_SESSION_ID=%s' % session_id})
+            self._lock.acquire()
+            try:
+                self.stats['requests'] += 1
+                self.stats['expired'] += expired
+            finally:
+                self._lock.release()
+            return resp, content
+        finally:
+            self._slots.release()
+    
+    def close(self):
+        r"""Drops the pooled connections and forgets the session."""
+        self._lock.acquire()
+        try:
+            self._idle = []
+            self.session_id = None
+        finally:
+            self._lock.release()
+    
+    def _connect(self):
+        return httplib2.Http(timeout=self.timeout)
+    
+    def _checkout(self):
+        # Callers hold a slot, so there are at most max_connections
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+        finally:
+            self._lock.release()
+        return self._connect()
+    
+    def _checkin(self, http):
+        self._lock.acquire()
+        try:
+            self._idle.append(http)
+        finally:
+            self._lock.release()
+    
+    def _session_id(self, resp):
+        # httplib2's responses are dicts of headers, httplib's aren't
+        if isinstance(resp, dict):
+            set_cookie = resp.get('set-cookie')
+        else:
+            set_cookie = resp.getheader('set-cookie')
+        match = self.SESSION_ID_REGEX.search(set_cookie or '')
+        return match.group(1) if match else None
+    
+    def _expired(self, session_id, resp, content):
+        r"""
+        Whether a response shows session_id has expired: the server started 
+        a new session or sent the login form back.
+        """
+        new_id = self._session_id(resp)
+        if new_id is not None and new_id != session_id:
+            return True
+        return content.find(self.LOGIN_FORM_MARKER) != -1
+
+
+class PageCache(object):
+    r"""
+    Persistent, SQLite-backed cache of WebPac pages for Reader.get_page.
+    
+    Pages are kept for a time-to-live that depends on the kind of page 
+    (see TTLS; MARC pages change far less often than holdings). Once a page 
+    goes stale it is revalidated with If-None-Match/If-Modified-Since when 
+    the server supplied an ETag or Last-Modified header. If max_entries or 
+    max_bytes is given, the least recently used pages are evicted to stay 
+    within the limit. Hit, miss, revalidation and eviction counts are kept 
+    in the stats dict.
+    
+    Access times are written in batches (once ACCESS_BATCH pages have been 
+    hit, before evicting and on close) rather than on every hit, and the 
+    page count and size are kept as running totals, so the limits are 
+    checked without scanning the table. The totals assume one PageCache 
+    per database file.
+    
+    >>> cache = PageCache(':memory:', max_entries=2)
+    >>> cache.store('http://opac/record=b1~S2', '<html>b1</html>')
+    >>> cache.lookup('http://opac/record=b1~S2')['content']
+    '<html>b1</html>'
+    >>> cache.lookup('http://opac/record=b2~S2') is None
+    True
+    >>> cache.store('http://opac/record=b2~S2', '<html>b2</html>')
+    >>> cache.store('http://opac/record=b3~S2', '<html>b3</html>')
+    >>> cache.lookup('http://opac/record=b1~S2') is None
+    True
+    >>> sorted(cache.stats.items())
+    [('evictions', 1), ('hits', 1), ('misses', 2), ('revalidations', 0), ('stale', 0)]
+    """
+    
+    TTLS = {
+        'marc': 7 * 24 * 60 * 60,
+        'record': 24 * 60 * 60,
+        'holdings': 60 * 60,
+        None: 60 * 60,
+    }
+    
+    PAGE_KINDS = (
+        ('marc', re.compile(r'/marc~')),
+        ('holdings', re.compile(r'/holdings')),
+        ('record', re.compile(r'/record=')),
+    )
+    
+    ACCESS_BATCH = 100
+    
+    def __init__(self, path, ttls=None, max_entries=None, max_bytes=None):
+        self.path = path
+        self.ttls = dict(self.TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = dict.fromkeys(
+            ('hits', 'misses', 'stale', 'revalidations', 'evictions'), 0)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("""CREATE TABLE IF NOT EXISTS pages (
+                                url TEXT PRIMARY KEY,
+                                content BLOB,
+                                etag TEXT,
+                                last_modified TEXT,
+                                stored_at REAL,
+                                accessed_at REAL,
+                                size INTEGER)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS pages_accessed_at 
+                            ON pages (accessed_at)""")
+        self._db.commit()
+        self._count, self._size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        # url => time of the last hit, not yet written to accessed_at
+        self._accessed = {}
+    
+    def kind(self, url):
+        r"""
+        Returns the kind of WebPac page for url ('marc', 'holdings', 
+        'record' or None), which determines its TTL.
+        
+        >>> cache = PageCache(':memory:')
+        >>> cache.kind(Reader.URI_FOR_HOLDINGS.substitute(host='', bibnum='b1', scope=2))
+        'holdings'
+        """
+        for kind, pattern in self.PAGE_KINDS:
+            if pattern.search(url):
+                return kind
+        return None
+    
+    def lookup(self, url):
+        r"""
+        Returns a dict with the cached content, its ETag and Last-Modified 
+        validators and whether it's still fresh, or None if url isn't 
+        cached.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            row = self._db.execute("""SELECT content, etag, last_modified, 
+                                      stored_at FROM pages WHERE url = ?""", 
+                                   (url,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            fresh = now - row[3] < self.ttls.get(self.kind(url), self.ttls[None])
+            self.stats['hits' if fresh else 'stale'] += 1
+            self._accessed[url] = now
+            if len(self._accessed) >= self.ACCESS_BATCH:
+                self._flush_accessed()
+                self._db.commit()
+        finally:
+            self._lock.release()
+        return {
+            'content': str(row[0]),
+            'etag': row[1],
+            'last_modified': row[2],
+            'fresh': fresh,
+        }
+    
+    def store(self, url, content, etag=None, last_modified=None):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._accessed.pop(url, None)
+            self._forget(url)
+            self._db.execute("""INSERT OR REPLACE INTO pages VALUES 
+                                (?, ?, ?, ?, ?, ?, ?)""", 
+                             (url, sqlite3.Binary(content), etag, 
+                              last_modified, now, now, len(content)))
+            self._count += 1
+            self._size += len(content)
+            self._evict()
+            self._db.commit()
+        finally:
+            self._lock.release()
+    
+    def revalidated(self, url):
+        r"""Marks url as fresh again after a 304 Not Modified response."""
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE pages SET stored_at = ? WHERE url = ?", 
+                             (time.time(), url))
+            self._db.commit()
+            self.stats['revalidations'] += 1
+        finally:
+            self._lock.release()
+    
+    def invalidate(self, url=None):
+        r"""Removes url from the cache, or every page if url is None."""
+        self._lock.acquire()
+        try:
+            if url is None:
+                self._db.execute("DELETE FROM pages")
+                self._accessed.clear()
+                self._count = self._size = 0
+            else:
+                self._accessed.pop(url, None)
+                self._forget(url)
+                self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._db.commit()
+        finally:
+            self._lock.release()
+    
+    def _within_limits(self):
+        return ((self.max_entries is None or self._count <= self.max_entries) and 
+                (self.max_bytes is None or self._size <= self.max_bytes))
+    
+    def _forget(self, url):
+        # Takes a page that's about to be replaced or deleted off the totals
+        row = self._db.execute("SELECT size FROM pages WHERE url = ?", 
+                               (url,)).fetchone()
+        if row is not None:
+            self._count -= 1
+            self._size -= row[0]
+    
+    def _flush_accessed(self):
+        if self._accessed:
+            self._db.executemany("UPDATE pages SET accessed_at = ? WHERE url = ?", 
+                                 [(t, url) for url, t in self._accessed.items()])
+            self._accessed.clear()
+    
+    def _evict(self):
+        if self._within_limits():
+            return
+        # Least recently used first, so pending hits have to be written
+        self._flush_accessed()
+        rows = self._db.execute(
+            "SELECT url, size FROM pages ORDER BY accessed_at, rowid")
+        evicted = []
+        for url, page_size in rows:
+            if self._within_limits():
+                break
+            evicted.append((url,))
+            self._count -= 1
+            self._size -= page_size
+        self._db.executemany("DELETE FROM pages WHERE url = ?", evicted)
+        self.stats['evictions'] += len(evicted)
+    
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._flush_accessed()
+            self._db.commit()
+        finally:
+            self._lock.release()
+        self._db.close()
+
+
+class RecordCache(object):
+    r"""
+    Thread-safe, in-memory LRU cache of decoded Record objects, keyed by 
+    (host, scope, bibnumber). Holds at most max_entries records and, if 
+    max_bytes is given, at most that many bytes of record data (measured by 
+    the length of Record.raw). Records older than ttl seconds are treated 
+    as missing.
+    
+    Cached records are shared between callers, so they shouldn't be 
+    modified in place.
+    
+    >>> cache = RecordCache(max_entries=2)
+    >>> for bibnumber in ('b1', 'b2', 'b3'):
+    ...     record = Record()
+    ...     record.bibnumber = bibnumber
+    ...     cache.set(('opac', 2, bibnumber), record)
+    >>> cache.get(('opac', 2, 'b1')) is None
+    True
+    >>> cache.get(('opac', 2, 'b3')).bibnumber
+    'b3'
+    >>> cache.invalidate(('opac', 2, 'b3'))
+    >>> len(cache)
+    1
+    """
+    
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = dict.fromkeys(('hits', 'misses', 'evictions'), 0)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            record, size, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                self._bytes -= size
+                self.stats['misses'] += 1
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+            return record
+        finally:
+            self._lock.release()
+    
+    def set(self, key, record):
+        size = len(record.raw) if record.raw else 0
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (record, size, time.time())
+            self._bytes += size
+            while self._entries and (
+                    len(self._entries) > self.max_entries or 
+                    (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self.stats['evictions'] += 1
+        finally:
+            self._lock.release()
+    
+    def invalidate(self, key=None):
+        r"""Removes key from the cache, or every record if key is None."""
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+        finally:
+            self._lock.release()
+
+
+class Metrics(object):
+    r"""
+    Collects per-phase latency histograms and counters from a Reader (see 
+    its metrics option). Each observation is also passed to any callbacks, 
+    as callback(kind, name, value) with kind 'phase' (value in seconds) or 
+    'counter' (value is the increment). snapshot, to_json and 
+    to_prometheus report what has been collected so far.
+    
+    >>> metrics = Metrics(buckets=(0.1, 1.0))
+    >>> seen = []
+    >>> metrics.callbacks.append(lambda kind, name, value: seen.append((kind, name)))
+    >>> metrics.observe('decode', 0.05)
+    >>> metrics.observe('decode', 0.5)
+    >>> metrics.incr('bytes_received', 2048)
+    >>> metrics.timed('decode', int, 'x')
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    >>> snapshot = metrics.snapshot()
+    >>> snapshot['phases']['decode']['count'], snapshot['phases']['decode']['errors']
+    (3, 1)
+    >>> snapshot['counters']
+    {'bytes_received': 2048, 'errors': 1}
+    >>> print '\n'.join(metrics.to_prometheus().split('\n')[:2])
+    # TYPE iiitools_bytes_received_total counter
+    iiitools_bytes_received_total 2048
+    >>> seen[:3]
+    [('phase', 'decode'), ('phase', 'decode'), ('counter', 'bytes_received')]
+    """
+    
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+    
+    def __init__(self, buckets=None, callbacks=None):
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.callbacks = list(callbacks or [])
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.phases = {}
+            self.counters = {}
+        finally:
+            self._lock.release()
+    
+    def observe(self, phase, seconds, error=False):
+        r"""Records a phase that took seconds (and failed, if error)."""
+        self._lock.acquire()
+        try:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = {'count': 0, 'sum': 0.0, 'errors': 0, 
+                                              'buckets': [0] * len(self.buckets)}
+            stats['count'] += 1
+            stats['sum'] += seconds
+            if error:
+                stats['errors'] += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+                    break
+        finally:
+            self._lock.release()
+        for callback in self.callbacks:
+            callback('phase', phase, seconds)
+    
+    def incr(self, counter, value=1):
+        self._lock.acquire()
+        try:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+        finally:
+            self._lock.release()
+        for callback in self.callbacks:
+            callback('counter', counter, value)
+    
+    def timed(self, phase, func, *args):
+        r"""
+        Calls func(*args) and records how long it took as phase. Exceptions 
+        are counted as errors (of the phase and overall) and re-raised.
+        """
+        started = time.time()
+        try:
+            result = func(*args)
+        except Exception:
+            self.observe(phase, time.time() - started, error=True)
+            self.incr('errors')
+            raise
+        self.observe(phase, time.time() - started)
+        return result
+    
+    def snapshot(self):
+        r"""
+        Returns a copy of the collected data: {'phases': {phase: {'count', 
+        'sum', 'errors', 'buckets'}}, 'counters': {name: value}}, where 
+        buckets is a list of cumulative (upper bound, count) pairs.
+        """
+        self._lock.acquire()
+        try:
+            phases = {}
+            for phase, stats in self.phases.items():
+                total = 0
+                buckets = []
+                for bound, count in zip(self.buckets, stats['buckets']):
+                    total += count
+                    buckets.append((bound, total))
+                buckets.append(('+Inf', stats['count']))
+                phases[phase] = {'count': stats['count'], 'sum': stats['sum'], 
+                                 'errors': stats['errors'], 'buckets': buckets}
+            return {'phases': phases, 'counters': dict(self.counters)}
+        finally:
+            self._lock.release()
+    
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+    
+    def to_prometheus(self, prefix='iiitools'):
+        r"""Returns the snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for counter, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, counter))
+            lines.append('%s_%s_total %s' % (prefix, counter, value))
+        name = prefix + '_phase_seconds'
+        if snapshot['phases']:
+            lines.append('# TYPE %s histogram' % name)
+        for phase, stats in sorted(snapshot['phases'].items()):
+            for bound, count in stats['buckets']:
+                lines.append('%s_bucket{phase="%s",le="%s"} %d' % (name, phase, bound, count))
+            lines.append('%s_sum{phase="%s"} %r' % (name, phase, stats['sum']))
+            lines.append('%s_count{phase="%s"} %d' % (name, phase, stats['count']))
+        name = prefix + '_phase_errors_total'
+        if snapshot['phases']:
+            lines.append('# TYPE %s counter' % name)
+        for phase, stats in sorted(snapshot['phases'].items()):
+            lines.append('%s{phase="%s"} %d' % (name, phase, stats['errors']))
+        return '\n'.join(lines) + '\n'
+
+
+class RangePlanner(object):
+    r"""
+    Plans crawls over bib number ranges with large holes in them (purged 
+    ranges, reserved blocks). The range is cut into blocks of block_size 
+    numbers and each block's density is estimated by probing samples 
+    evenly spaced bib numbers with reader.record_exists. Blocks with no 
+    hits are probed again in halves, down to min_block_size, before being 
+    written off as empty, so small clusters of records aren't lost 
+    (clusters narrower than min_block_size / samples can still slip 
+    through; use skip_empty=False to keep empty stretches as 0-estimate 
+    shards for a later pass).
+    
+    Probe results are remembered (and can be added to with observe), so 
+    the planner's picture of the range gets sharper the more it is used.
+    
+    >>> class FakeReader(object):
+    ...     def record_exists(self, bibnumber):
+    ...         return 1000000 <= int(bibnumber[1:]) < 1002000
+    >>> planner = RangePlanner(FakeReader(), block_size=1000, min_block_size=250, shard_size=600)
+    >>> [(s['start'], s['end'], s['estimate']) for s in planner.plan('b999000', 'b1004999')]
+    [('b1000000', 'b1000599', 600), ('b1000600', 'b1001199', 600), ('b1001200', 'b1001799', 600), ('b1001800', 'b1001999', 200)]
+    """
+    
+    def __init__(self, reader, block_size=1000, min_block_size=125, 
+                 samples=4, shard_size=1000, skip_empty=True):
+        self.reader = reader
+        self.block_size = block_size
+        self.min_block_size = min_block_size
+        self.samples = samples
+        self.shard_size = shard_size
+        self.skip_empty = skip_empty
+        self.observations = {}      # bib number (int) => exists
+        self.stats = dict.fromkeys(('probes', 'skipped'), 0)
+    
+    def observe(self, bibnumber, exists):
+        r"""Records whether bibnumber exists, e.g. as found by a crawl."""
+        self.observations[int(bibnumber[1:])] = exists
+    
+    def exists(self, num):
+        if num not in self.observations:
+            self.stats['probes'] += 1
+            self.observations[num] = bool(self.reader.record_exists("b%s" % (num,)))
+        return self.observations[num]
+    
+    def density(self, start, end):
+        r"""
+        Estimates the fraction of bib numbers in [start, end) that exist 
+        from the known and sampled numbers in that range.
+        """
+        width = end - start
+        step = max(1, width // self.samples)
+        nums = set(range(start + step // 2, end, step))
+        # Count everything already known about the range too
+        if len(self.observations) < width:
+            nums.update(n for n in self.observations if start <= n < end)
+        else:
+            nums.update(n for n in range(start, end) if n in self.observations)
+        hits = sum(1 for n in nums if self.exists(n))
+        return float(hits) / len(nums)
+    
+    def _blocks(self, start, end):
+        r"""Yields (start, end, density) for the non-empty parts of [start, end)."""
+        density = self.density(start, end)
+        if density == 0 and end - start > self.min_block_size:
+            middle = start + (end - start) // 2
+            for block in self._blocks(start, middle):
+                yield block
+            for block in self._blocks(middle, end):
+                yield block
+        elif density == 0:
+            self.stats['skipped'] += end - start
+            if not self.skip_empty:
+                yield (start, end, 0.0)
+        else:
+            yield (start, end, density)
+    
+    def plan(self, bib_start, bib_end):
+        r"""
+        Returns the shards to crawl for bib_start to bib_end (inclusive), 
+        in order, as dicts with 'start' and 'end' bib numbers and an 
+        'estimate' of the records in between. Empty stretches are left out 
+        (or given an estimate of 0 if skip_empty is False) and dense ones 
+        are split so each shard holds about shard_size records.
+        """
+        if not bib_start.startswith('b') or not bib_end.startswith('b'):
+            raise ValueError("Invalid bib record number(s).")
+        start, end = int(bib_start[1:]), int(bib_end[1:]) + 1
+        
+        blocks = []
+        for block_start in range(start, end, self.block_size):
+            blocks.extend(self._blocks(block_start, 
+                                       min(end, block_start + self.block_size)))
+        
+        shards = []
+        shard = None
+        for block_start, block_end, density in blocks:
+            if density == 0:
+                shards.append(self._shard(block_start, block_end, 0))
+                shard = None
+                continue
+            if shard is not None and shard['_end'] != block_start:
+                shard = None
+            pos = block_start
+            while pos < block_end:
+                if shard is None:
+                    shard = self._shard(pos, pos, 0)
+                    shards.append(shard)
+                # Numbers needed to fill the shard at this density
+                room = int(round((self.shard_size - shard['estimate']) / density))
+                take = max(1, min(block_end - pos, room))
+                shard['_end'] = pos + take
+                shard['end'] = "b%s" % (pos + take - 1,)
+                shard['estimate'] = int(round(shard['estimate'] + take * density))
+                pos += take
+                if shard['estimate'] >= self.shard_size:
+                    shard = None
+        
+        for shard in shards:
+            shard.pop('_end', None)
+        return shards
+    
+    def _shard(self, start, end, estimate):
+        return {'start': "b%s" % (start,), 'end': "b%s" % (end - 1,), 
+                '_end': end, 'estimate': estimate}
+    
+    def bibnumbers(self, shard):
+        r"""
+        Yields (bibnumber, check digit) for every bib number in shard.
+        
+        >>> list(RangePlanner(None).bibnumbers({'start': 'b1012751', 'end': 'b1012752'}))
+        [('b1012751', '3'), ('b1012752', '5')]
+        """
+        for bibnumber in bib_range(shard['start'], shard['end']):
+            yield bibnumber, check_digit(bibnumber)
+    
+    def iter_records(self, bib_start, bib_end, workers=1):
+        r"""
+        Plans the range and crawls it shard by shard with 
+        reader.iter_records, yielding records in bib number order.
+        """
+        for shard in self.plan(bib_start, bib_end):
+            for record in self.reader.iter_records(shard['start'], shard['end'], 
+                                                   workers=workers):
+                self.observe(record.bibnumber, True)
+                yield record
+
+
+class HarvestState(object):
+    r"""
+    Local SQLite store of what the last harvest saw for each bib number 
+    (its 005 timestamp and a hash of its raw text), used by 
+    Reader.iter_changes to tell new, changed and deleted records apart.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("""CREATE TABLE IF NOT EXISTS bibs (
+                                num INTEGER PRIMARY KEY,
+                                bibnumber TEXT,
+                                f005 TEXT,
+                                digest TEXT,
+                                seen_at REAL,
+                                deleted INTEGER DEFAULT 0)""")
+        self._db.commit()
+    
+    def get_many(self, bibnumbers):
+        r"""Returns a dict of bibnumber => stored state for bibnumbers."""
+        nums = [int(b[1:]) for b in bibnumbers]
+        if not nums:
+            return {}
+        self._lock.acquire()
+        try:
+            rows = self._db.execute(
+                """SELECT bibnumber, f005, digest, deleted FROM bibs 
+                   WHERE num BETWEEN ? AND ?""", (min(nums), max(nums))).fetchall()
+        finally:
+            self._lock.release()
+        return dict((row[0], {'f005': row[1], 'digest': row[2], 'deleted': bool(row[3])}) 
+                    for row in rows)
+    
+    def latest_changes(self, start, end, block_size):
+        r"""
+        Returns a dict of block number ((num - start) // block_size, as 
+        iter_changes cuts its blocks) => the latest 005 value stored for the 
+        bib numbers in that block.
+        
+        >>> state = HarvestState(':memory:')
+        >>> state.update('b1600', '20100101000000.0', '')
+        >>> state.update('b2600', '20110101000000.0', '')
+        >>> sorted(state.latest_changes(1500, 3499, 1000).items())
+        [(0, '20100101000000.0'), (1, '20110101000000.0')]
+        """
+        self._lock.acquire()
+        try:
+            return dict(self._db.execute(
+                """SELECT (num - ?) / ?, COALESCE(MAX(f005), '') FROM bibs 
+                   WHERE num BETWEEN ? AND ? GROUP BY (num - ?) / ?""", 
+                (start, block_size, start, end, start, block_size)).fetchall())
+        finally:
+            self._lock.release()
+    
+    def update(self, bibnumber, f005, digest):
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO bibs VALUES (?, ?, ?, ?, ?, 0)", 
+                             (int(bibnumber[1:]), bibnumber, f005, digest, time.time()))
+        finally:
+            self._lock.release()
+    
+    def mark_deleted(self, bibnumber):
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE bibs SET deleted = 1, seen_at = ? WHERE num = ?", 
+                             (time.time(), int(bibnumber[1:])))
+        finally:
+            self._lock.release()
+    
+    def commit(self):
+        self._lock.acquire()
+        try:
+            self._db.commit()
+        finally:
+            self._lock.release()
+    
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
+class LeaseLostError(Exception):
+    r"""Raised when a worker's lease on a shard has expired or been taken."""
+
+
+class WorkQueue(object):
+    r"""
+    Shared, SQLite-backed queue of bib range shards for harvesting with 
+    several processes or hosts (the database file has to be on storage all 
+    of them can lock, e.g. a local disk or a reliable shared filesystem). 
+    
+    Workers lease a shard, heartbeat while crawling it and mark it complete 
+    when done. A shard whose lease runs out (lease_time seconds after the 
+    last heartbeat) is handed to the next worker that asks, and completing 
+    an already completed shard is a no-op. Only the worker holding the 
+    lease can complete a shard. See harvest_shards.
+    
+    >>> queue = WorkQueue(':memory:', lease_time=60)
+    >>> queue.add_range('b1000000', 'b1002499', shard_size=1000)
+    3
+    >>> shard = queue.lease('worker-1')
+    >>> shard['start'], shard['end']
+    ('b1000000', 'b1000999')
+    >>> queue.heartbeat(shard['id'], 'worker-1')
+    True
+    >>> queue.complete(shard['id'], 'worker-1', records=812)
+    True
+    >>> queue.complete(shard['id'], 'worker-2', records=812)
+    False
+    >>> sorted(queue.progress().items())
+    [('done', 1), ('leased', 0), ('pending', 2)]
+    """
+    
+    def __init__(self, path, lease_time=300):
+        self.path = path
+        self.lease_time = lease_time
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, 
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("""CREATE TABLE IF NOT EXISTS shards (
+                                id INTEGER PRIMARY KEY,
+                                start TEXT,
+                                end TEXT,
+                                estimate INTEGER,
+                                state TEXT DEFAULT 'pending',
+                                worker TEXT,
+                                lease_expires REAL,
+                                attempts INTEGER DEFAULT 0,
+                                records INTEGER,
+                                finished_at REAL,
+                                UNIQUE (start, end))""")
+    
+    def _execute(self, sql, params=()):
+        self._lock.acquire()
+        try:
+            # BEGIN IMMEDIATE takes the write lock up front so two workers 
+            # can't lease the same shard
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._db.execute(sql, params)
+                self._db.execute("COMMIT")
+                return cursor
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+        finally:
+            self._lock.release()
+    
+    def add_shards(self, shards):
+        r"""
+        Adds shards (dicts with 'start', 'end' and optionally 'estimate', as 
+        returned by RangePlanner.plan) to the queue, skipping any already 
+        queued. Returns the number added.
+        """
+        self._lock.acquire()
+        try:
+            before = self._db.total_changes
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany(
+                "INSERT OR IGNORE INTO shards (start, end, estimate) VALUES (?, ?, ?)", 
+                [(s['start'], s['end'], s.get('estimate')) for s in shards])
+            self._db.execute("COMMIT")
+            return self._db.total_changes - before
+        finally:
+            self._lock.release()
+    
+    def add_range(self, bib_start, bib_end, shard_size=1000):
+        r"""Splits bib_start to bib_end (inclusive) into shards and adds them."""
+        if not bib_start.startswith('b') or not bib_end.startswith('b'):
+            raise ValueError("Invalid bib record number(s).")
+        start, end = int(bib_start[1:]), int(bib_end[1:])
+        return self.add_shards([
+            {'start': "b%s" % (num,), 'end': "b%s" % (min(end, num + shard_size - 1),)} 
+            for num in range(start, end + 1, shard_size)])
+    
+    def lease(self, worker):
+        r"""
+        Leases the next pending (or expired) shard to worker and returns it 
+        as a dict, or returns None if there's nothing left to lease.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    """SELECT id, start, end, estimate, attempts FROM shards 
+                       WHERE state = 'pending' 
+                          OR (state = 'leased' AND lease_expires < ?) 
+                       ORDER BY id LIMIT 1""", (now,)).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        """UPDATE shards SET state = 'leased', worker = ?, 
+                           lease_expires = ?, attempts = attempts + 1 
+                           WHERE id = ?""", (worker, now + self.lease_time, row[0]))
+                self._db.execute("COMMIT")
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+        finally:
+            self._lock.release()
+        if row is None:
+            return None
+        return {'id': row[0], 'start': row[1], 'end': row[2], 
+                'estimate': row[3], 'attempt': row[4] + 1}
+    
+    def heartbeat(self, shard_id, worker):
+        r"""
+        Extends worker's lease on a shard. Returns False if the lease has 
+        been lost (it expired and another worker took the shard).
+        """
+        cursor = self._execute(
+            """UPDATE shards SET lease_expires = ? WHERE id = ? 
+               AND worker = ? AND state = 'leased'""", 
+            (time.time() + self.lease_time, shard_id, worker))
+        return cursor.rowcount == 1
+    
+    def complete(self, shard_id, worker, records=None):
+        r"""
+        Marks worker's shard as done. Returns False if it was already done, 
+        so results committed twice are only counted once, or if the shard 
+        has since been leased to another worker (whose results count 
+        instead).
+        """
+        cursor = self._execute(
+            """UPDATE shards SET state = 'done', records = ?, finished_at = ? 
+               WHERE id = ? AND worker = ? AND state = 'leased'""", 
+            (records, time.time(), shard_id, worker))
+        return cursor.rowcount == 1
+    
+    def release(self, shard_id, worker):
+        r"""Gives up worker's lease so another worker can take the shard."""
+        self._execute(
+            """UPDATE shards SET state = 'pending', worker = NULL, 
+               lease_expires = NULL WHERE id = ? AND worker = ? 
+               AND state = 'leased'""", (shard_id, worker))
+    
+    def progress(self):
+        r"""Returns the number of shards in each state."""
+        counts = dict.fromkeys(('pending', 'leased', 'done'), 0)
+        self._lock.acquire()
+        try:
+            rows = self._db.execute(
+                "SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall()
+        finally:
+            self._lock.release()
+        counts.update(rows)
+        return counts
+    
+    def close(self):
+        self._db.close()
+
+
+class _LeaseKeeper(threading.Thread):
+    r"""
+    Renews worker's lease on a shard every interval seconds until stopped, 
+    so the lease stays alive however long the sink spends on (or after) 
+    each record. Sets lost if a renewal fails.
+    """
+    
+    def __init__(self, queue, shard, worker, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.shard = shard
+        self.worker = worker
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+    
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                renewed = self.queue.heartbeat(self.shard['id'], self.worker)
+            except Exception:
+                # Can't tell whether the lease is still ours
+                renewed = False
+            if not renewed:
+                self.lost.set()
+                return
+    
+    def stop(self):
+        self._stopped.set()
+        self.join()
+    
+    def check(self):
+        if self.lost.is_set():
+            raise LeaseLostError("Lost lease on shard %s-%s" % 
+                                 (self.shard['start'], self.shard['end']))
+    
+    def watch(self, records):
+        r"""Passes records through, raising LeaseLostError once it's lost."""
+        for record in records:
+            self.check()
+            yield record
+
+
+def harvest_shards(reader, queue, sink, worker=None, workers=1, 
+                   heartbeat_interval=30, poll_interval=5):
+    r"""
+    Worker loop for a distributed harvest: leases shards from queue, 
+    crawls each with reader.iter_records and passes (shard, records) to 
+    sink, which should store the records under the shard (e.g. one file per 
+    shard, replaced atomically) and return how many it stored. The lease is 
+    renewed every heartbeat_interval seconds from a background thread for 
+    as long as sink runs; if it is lost, LeaseLostError is raised from the 
+    records iterator (or the sink's result is dropped) and the shard is 
+    left to whoever holds it now.
+    
+    While other workers still hold leases, waits poll_interval seconds and 
+    asks again, in case one of them dies. Returns the number of shards 
+    this worker completed. Run one per process or host.
+    
+    >>> class FakeReader(object):
+    ...     def iter_records(self, bib_start, bib_end, workers=1):
+    ...         return iter(bib_range(bib_start, bib_end)[::2])
+    >>> queue = WorkQueue(':memory:')
+    >>> queue.add_range('b1000', 'b1999', shard_size=250)
+    4
+    >>> harvest_shards(FakeReader(), queue, lambda shard, records: len(list(records)))
+    4
+    """
+    if worker is None:
+        worker = "%s-%s" % (socket.gethostname(), os.getpid())
+    
+    completed = 0
+    while True:
+        shard = queue.lease(worker)
+        if shard is None:
+            if queue.progress()['leased']:
+                time.sleep(poll_interval)
+                continue
+            return completed
+        
+        keeper = _LeaseKeeper(queue, shard, worker, heartbeat_interval)
+        keeper.start()
+        try:
+            try:
+                count = sink(shard, keeper.watch(
+                    reader.iter_records(shard['start'], shard['end'], workers=workers)))
+            finally:
+                keeper.stop()
+            keeper.check()
+        except LeaseLostError:
+            continue
+        except:
+            queue.release(shard['id'], worker)
+            raise
+        if queue.complete(shard['id'], worker, count):
+            completed += 1
+
+
+def write_jsonl(records, out, keys=None, buffer_size=64 * 1024):
+    r"""
+    Writes records to out as JSON Lines, one object per record, and 
+    returns the number of records written. keys limits each object to the 
+    given Record.as_dict keys so only those properties are computed. 
+    
+    Records are consumed one at a time and output is written whenever 
+    buffer_size bytes have accumulated, so records can be any iterable 
+    (e.g. Reader.iter_records) and out can be a file or a socket.
+    
+    >>> import StringIO
+    >>> reader = Reader('http://opac.uthsc.edu', 2)
+    >>> records = reader.decode_records(["LEADER 00000cas  2200517 a 4500 \n022    0003-3995 \n245 00 Annales de genetique. "])
+    >>> out = StringIO.StringIO()
+    >>> write_jsonl(records, out, ['title', 'issn'])
+    1
+    >>> print out.getvalue(),
+    {"title": "Annales de genetique", "issn": ["0003-3995"]}
+    """
+    write = out.sendall if hasattr(out, 'sendall') else out.write
+    buffered = []
+    buffered_size = 0
+    count = 0
+    for record in records:
+        if record is None:
+            continue
+        line = json.dumps(record.as_dict(keys)) + '\n'
+        buffered.append(line)
+        buffered_size += len(line)
+        count += 1
+        if buffered_size >= buffer_size:
+            write(''.join(buffered))
+            buffered = []
+            buffered_size = 0
+    if buffered:
+        write(''.join(buffered))
+    if hasattr(out, 'flush'):
+        out.flush()
+    return count
+
+def convert_dump(path, out, format='marc', processes=None, keys=None, 
+                 chunk_size=4 * 1024 * 1024, encoding='latin1'):
+    r"""
+    Decodes a dump file of proto-MARC records (Record.raw texts, one after 
+    another, each starting with its LEADER line) and writes them to out as 
+    binary MARC21 ('marc'), MARCXML ('xml') or JSON Lines ('jsonl', 
+    limited to keys as in write_jsonl). Returns the number of records 
+    written.
+    
+    The dump is memory-mapped and split into chunks of about chunk_size 
+    bytes on record boundaries, and the chunks are decoded and serialised 
+    on a pool of processes worker processes (one per CPU by default). 
+    Output is written in dump order as each chunk is finished. encoding is 
+    the dump's text encoding.
+    
+    >>> import os, StringIO, tempfile
+    >>> fd, path = tempfile.mkstemp()
+    >>> written = os.write(fd, "\nLEADER 00000cas  2200517 a 4500 \n022    0003-3995 \n245 00 Annales de genetique. \n"
+    ...              "\nLEADER 00000nam  2200205 a 4500 \n245 10 Soci\xe9t\xe9 & Cie. \n")
+    >>> out = StringIO.StringIO()
+    >>> convert_dump(path, out, 'jsonl', processes=1, keys=['title', 'issn'])
+    2
+    >>> print out.getvalue(),
+    {"title": "Annales de genetique", "issn": ["0003-3995"]}
+    {"title": "Soci\u00e9t\u00e9 & Cie", "issn": []}
+    >>> out = StringIO.StringIO()
+    >>> convert_dump(path, out, 'marc', processes=1, chunk_size=16)
+    2
+    >>> out.getvalue()[:24]
+    '00090cas a2200049 a 4500'
+    >>> os.close(fd); os.remove(path)
+    """
+    if format not in DUMP_FORMATS:
+        raise ValueError("Unknown dump format: %r" % format)
+    
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return 0
+        dump = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunks = []
+            start = 0
+            while start < size:
+                # Cut at the start of the first record after chunk_size
+                end = dump.find('\nLEADER ', start + chunk_size)
+                end = size if end == -1 else end + 1
+                chunks.append((path, start, end, format, keys, encoding))
+                start = end
+        finally:
+            dump.close()
+    finally:
+        f.close()
+    
+    header, footer = DUMP_FORMATS[format]
+    out.write(header)
+    count = 0
+    if processes == 1 or len(chunks) == 1:
+        results = (_convert_dump_chunk(chunk) for chunk in chunks)
+        pool = None
+    else:
+        pool = Pool(processes)
+        results = pool.imap(_convert_dump_chunk, chunks)
+    try:
+        for chunk_count, data in results:
+            out.write(data)
+            count += chunk_count
+    finally:
+        if pool is not None:
+            pool.terminate()
+    out.write(footer)
+    return count
+
+# format => (header, footer) of convert_dump's output
+DUMP_FORMATS = {
+    'marc': ('', ''),
+    'xml': ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<collection xmlns="http://www.loc.gov/MARC21/slim">\n', '</collection>\n'),
+    'jsonl': ('', ''),
+}
+
+DUMP_SPLIT_REGEX = re.compile(r'\n(?=LEADER )')
+
+def _convert_dump_chunk(args):
+    r"""
+    Worker for convert_dump: decodes the records in one chunk of the dump 
+    and returns (record count, serialised records).
+    """
+    path, start, end, format, keys, encoding = args
+    f = open(path, 'rb')
+    try:
+        dump = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = dump[start:end].decode(encoding)
+        finally:
+            dump.close()
+    finally:
+        f.close()
+    
+    reader = Reader(None)
+    records = reader.decode_records(DUMP_SPLIT_REGEX.split(text))
+    if format == 'jsonl':
+        out = StringIO()
+        count = write_jsonl(records, out, keys)
+        return count, out.getvalue()
+    serialise = record_to_marc21 if format == 'marc' else record_to_marcxml
+    parts = [serialise(record) for record in records if record is not None]
+    return len(parts), ''.join(parts)
+
+def record_to_marc21(record):
+    r"""
+    Returns record as binary MARC21 (ISO 2709), encoded as UTF-8 (leader 
+    position 9 is 'a').
+    
+    >>> reader = Reader('http://opac.uthsc.edu', 2)
+    >>> record = reader.decode_record("LEADER 00000nam  2200205 a 4500 \n001    123 \n245 10 Soci\xe9t\xe9. ")
+    >>> record_to_marc21(record)
+    '00069nam a2200049 a 4500001000400000245001500004\x1e123\x1e 1\x1faSoci\xc3\xa9t\xc3\xa9.\x1e\x1d'
+    """
+    # Field data is already UTF-8, so pymarc mustn't encode it again; 
+    # leader position 9 is set on the result instead.
+    leader = record.leader
+    record.leader = str(leader)[:9] + ' ' + str(leader)[10:]
+    try:
+        data = record.as_marc()
+    finally:
+        record.leader = leader
+    return data[:9] + 'a' + data[10:]
+
+def record_to_marcxml(record):
+    r"""
+    Returns record as a MARCXML <record> element (UTF-8), one per line.
+    
+    >>> reader = Reader('http://opac.uthsc.edu', 2)
+    >>> record = reader.decode_record("LEADER 00000nam  2200205 a 4500 \n001    123 \n245 10 Cats & dogs. ")
+    >>> print record_to_marcxml(record),
+    <record><leader>00000nam a2200205 a 4500</leader><controlfield tag="001">123</controlfield><datafield tag="245" ind1=" " ind2="1"><subfield code="a">Cats &amp; dogs.</subfield></datafield></record>
+    """
+    leader = str(record.leader)
+    parts = ['<record><leader>', escape(leader[:9] + 'a' + leader[10:]), '</leader>']
+    for field in record.fields:
+        if field.is_control_field():
+            parts.append('<controlfield tag=%s>%s</controlfield>' % (
+                         quoteattr(field.tag), escape(field.data)))
+        else:
+            parts.append('<datafield tag=%s ind1=%s ind2=%s>' % (
+                         quoteattr(field.tag), quoteattr(field.indicators[0]), 
+                         quoteattr(field.indicators[1])))
+            subfields = field.subfields
+            for i in range(0, len(subfields) - 1, 2):
+                parts.append('<subfield code=%s>%s</subfield>' % (
+                             quoteattr(subfields[i]), escape(subfields[i + 1])))
+            parts.append('</datafield>')
+    parts.append('</record>\n')
+    return ''.join(parts)
+
+def extract_columns(records, keys, arrays=True):
+    r"""
+    Extracts the given Record.as_dict keys from many records at once and 
+    returns an ordered dict of key => column, one value per record (None 
+    entries in records are skipped). Each 
+    record's fields are indexed once and shared by all requested columns. 
+    
+    If arrays is True and NumPy is installed, columns are NumPy arrays 
+    (string or numeric dtype where every value is a scalar, object dtype 
+    otherwise) so they can be filtered and aggregated vectorized; 
+    otherwise they're plain lists.
+    
+    >>> reader = Reader('http://opac.uthsc.edu', 2)
+    >>> records = reader.decode_records([
+    ...     "LEADER 00000cas  2200517 a 4500 \n022    0003-3995 \n245 00 Annales de genetique. ", 
+    ...     "LEADER 00000cam  2200517 a 4500 \n245 00 Molecular biology of the cell. "])
+    >>> columns = extract_columns(records, ['type', 'issn'], arrays=False)
+    >>> columns['type'], columns['issn']
+    (['SER', 'BKS'], [['0003-3995'], []])
+    """
+    keys = list(keys)
+    columns = OrderedDict((key, []) for key in keys)
+    appends = [columns[key].append for key in keys]
+    for record in records:
+        if record is None:
+            continue
+        for append, value in zip(appends, record.as_dict(keys).itervalues()):
+            append(value)
+    
+    if arrays:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            for key, values in columns.items():
+                columns[key] = _column_array(numpy, values)
+    return columns
+
+def _column_array(numpy, values):
+    if all(isinstance(v, (basestring, int, long, float)) for v in values):
+        return numpy.array(values)
+    # Lists (and None) have to go in an object array one at a time, or 
+    # NumPy would turn equal length lists into extra dimensions.
+    column = numpy.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        column[i] = value
+    return column
+
+def is_control_tag(tag):
+    r"""Control fields (001-009) have data but no indicators or subfields."""
+    return tag < '010' and tag.isdigit()
+
+def make_field(tag, indicator1, indicator2, data):
+    r"""
+    Builds a pymarc.Field from a decoded proto-MARC line. For data fields, 
+    data holds the subfields delimited by '|', with the first subfield's 
+    code already prepended.
+    
+    >>> print make_field('260', ' ', ' ', 'aParis :|bExpansion scientifique,|c1958-2004.')
+    =260  \\$aParis :$bExpansion scientifique,$c1958-2004.
+    """
+    if is_control_tag(tag):
+        return Field(tag=tag, indicators=[indicator1, indicator2], data=data)
+    
+    subfields = []
+    for sub in data.split('|'):
+        # Skip blank/empty subfields
+        if sub:
+            subfields += (sub[0].strip(), sub[1:].strip())
+    return Field(tag=tag, indicators=[indicator1, indicator2], 
+                 subfields=subfields)
+
+def classify_leaders(leaders):
+    r"""
+    Returns the record type (see Leader.type) for each leader in leaders, 
+    with None for leaders of an invalid type. leaders can be any sequence of 
+    leader strings; if it's a NumPy array of byte strings the lookup is 
+    vectorized and a NumPy object array is returned.
+    
+    >>> classify_leaders(['00000cas  2200517 a 4500', '00000cam  22', 'bogus'])
+    ['SER', 'BKS', None]
+    """
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    
+    if numpy is not None and isinstance(leaders, numpy.ndarray):
+        leaders = numpy.asarray(leaders, dtype='S24')
+        chars = leaders.view(numpy.uint8).reshape(len(leaders), 24)
+        codes = chars[:, 6].astype(numpy.intp) * 256 + chars[:, 7]
+        return _leader_type_array()[codes]
+    
+    types = Leader.TYPES
+    return [types.get(leader[6:8]) for leader in leaders]
+
+_LEADER_TYPE_ARRAY = None
+
+def _leader_type_array():
+    r"""
+    Returns a NumPy object array mapping type_code * 256 + blvl_code to 
+    record type, built on first use.
+    """
+    global _LEADER_TYPE_ARRAY
+    if _LEADER_TYPE_ARRAY is None:
+        import numpy
+        table = numpy.empty(256 * 256, dtype=object)
+        for key, type in Leader.TYPES.items():
+            table[ord(key[0]) * 256 + ord(key[1])] = type
+        _LEADER_TYPE_ARRAY = table
+    return _LEADER_TYPE_ARRAY
+
+def unescape_entities(text):
+    r"""
+    Removes HTML or XML character references and entities from a text string.
+    Keeps &amp;, &gt;, &lt; in the source code. Based on original from Fredrik 
+    Lundh. http://effbot.org/zone/re-sub.htm#unescape-html
+      
+    Note: 'text' must be a Unicode string
+    
+    >>> output = unescape_entities(u'This leads to &raquo; that')
+    >>> print output.encode('utf8')
+    This leads to » that
+    """
+    return ENTITY_REGEX.sub(_unescape_entity, text)
+
+ENTITY_REGEX = re.compile(ur'&#?\w+;', re.UNICODE)
+
+def _unescape_entity(m):
+    text = m.group(0)
+    if text[:2] == "&#":
+        # character reference
+        try:
+            if text[:3] == "&#x":
+                return unichr(int(text[3:-1], 16))
+            else:
+                return unichr(int(text[2:-1]))
+        except ValueError:
+            print "Some kind of ValueError encountered ..."
+            pass
+    else:
+        # named entity
+        try:
+            if text[1:-1] == "amp":
+                text = "&amp;amp;"
+            elif text[1:-1] == "gt":
+                text = "&amp;gt;"
+            elif text[1:-1] == "lt":
+                text = "&amp;lt;"
+            else:
+                text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
+        except KeyError:
+            print "keyerror"
+            pass
+    return text # leave as is
+
+def unescape_html(text):
+    r"""
+    Replaces every HTML character reference and entity in text (unicode), 
+    including &amp;, &gt; and &lt;, with the character it stands for. 
+    Unknown entities are left alone.
+    
+    >>> unescape_html(u'Oct&#47;Dec &amp; Suppl.&nbsp;&bogus;')
+    u'Oct/Dec & Suppl.\xa0&bogus;'
+    """
+    if u'&' not in text:
+        return text
+    return ENTITY_REGEX.sub(_unescape_html_entity, text)
+
+def _unescape_html_entity(m):
+    text = m.group(0)
+    try:
+        if text[:3] == u"&#x":
+            return unichr(int(text[3:-1], 16))
+        elif text[:2] == u"&#":
+            return unichr(int(text[2:-1]))
+        else:
+            return unichr(htmlentitydefs.name2codepoint[text[1:-1]])
+    except (ValueError, KeyError):
+        return text
+
+def check_digit(bibnumber):
+    """Calculates the check digit for a bib record number.
+
+    The algorithm to calculate check digits is found at the following URL:
+    http://csdirect.iii.com/manual/rmil_records_numbers.html
+    
+    >>> check_digit('b1012752')
+    '5'
+    """
+    if not bibnumber:
+        return None
+    else:        
+        total = 0
+        multiplier = 2
+        for i in reversed(bibnumber[1:]):
+            i = int(i)
+            assert 0 <= i <= 9
+            i *= multiplier
+            total += i
+            multiplier += 1
+        dig = total % 11
+        return str(dig) if dig != 10 else 'x'
+
+def bib_range(bib_start, bib_end):
+    r"""
+    Returns the list of bib record numbers from bib_start to bib_end 
+    (inclusive).
+    
+    >>> bib_range('b1053852', 'b1053854')
+    ['b1053852', 'b1053853', 'b1053854']
+    """
+    if not bib_start.startswith('b') or not bib_end.startswith('b'):
+        raise ValueError("Invalid bib record number(s).")
+    
+    return ["b%s" % (num,) for num in range(int(bib_start[1:]), int(bib_end[1:])+1)]
+
+def read_checkpoint(path):
+    r"""
+    Returns the bib number stored in a crawl checkpoint file, or None if 
+    there isn't one.
+    """
+    if not os.path.exists(path):
+        return None
+    f = open(path)
+    try:
+        return f.read().strip() or None
+    finally:
+        f.close()
+
+def write_checkpoint(path, bibnumber):
+    r"""
+    Stores bibnumber in a crawl checkpoint file. The file is replaced 
+    atomically so an interrupted write never leaves a partial checkpoint.
+    
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'crawl.checkpoint')
+    >>> print read_checkpoint(path)
+    None
+    >>> write_checkpoint(path, 'b1053860')
+    >>> read_checkpoint(path)
+    'b1053860'
+    """
+    tmp_path = "%s.tmp" % (path,)
+    f = open(tmp_path, 'w')
+    try:
+        f.write("%s\n" % (bibnumber,))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Windows won't rename over an existing file
+        os.remove(path)
+        os.rename(tmp_path, path)
 
 def strip_end_punctuation(text):
     return text[:-1] if text[-1] in string.punctuation else text
@@ -16,7 +16,7 @@ III Utils
 Utilities for interacting with III Millennium WebPac. Primary goal is to
 retrieve and parse bibliographic records via the WebPac proto-MARC output.
 
-Required: Python 2.5 or later
+Required: Python 2.7 or later
 Required: httplib2 <http://code.google.com/p/httplib2/>
 Required pymarc <http://github.com/edsu/pymarc>
 -----
@@ -24,6 +24,6 @@ Required pymarc <http://github.com/edsu/pymarc>
 To install:
 $ python setup.py install
 """,
-    version='1.07',
+    version='1.08',
     py_modules=['iiitools'],
 )
\ No newline at end of file